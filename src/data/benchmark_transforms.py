@@ -0,0 +1,72 @@
+'''
+Compare per-sample spectrogram augmentations with their batch versions.
+
+Random spectrograms of random lengths are augmented either one by one with RandomTimeShift,
+RandomTimeResize, TimeMasking and FrequencyMasking and then padded to a batch, or padded
+first and augmented with the batch transforms.
+'''
+import time
+import click
+import torch as t
+from torchaudio.transforms import TimeMasking, FrequencyMasking
+from torchvision.transforms import Compose, RandomApply
+from src.data.transforms import (
+    RandomTimeShift, RandomTimeResize, BatchRandomTimeShift, BatchRandomTimeResize,
+    BatchMasking, BatchCompose
+)
+
+
+def pad(mel_specs):
+    lengths = t.LongTensor([x.size(1) for x in mel_specs])
+    batch = t.zeros(len(mel_specs), mel_specs[0].size(0), int(lengths.max()))
+    for i, mel_spec in enumerate(mel_specs):
+        batch[i, :, :mel_spec.size(1)] = mel_spec
+    return batch, lengths
+
+
+@click.command()
+@click.option('--batch_size', default=16)
+@click.option('--n_mels', default=128)
+@click.option('--min_frames', default=100)
+@click.option('--max_frames', default=5000)
+@click.option('--n_batches', default=20)
+def main(batch_size, n_mels, min_frames, max_frames, n_batches):
+    transform = Compose([
+        RandomTimeShift(1.0),
+        RandomApply([RandomTimeResize(resize_mode='bilinear')], 0.5),
+        TimeMasking(10),
+        FrequencyMasking(8),
+    ])
+    batch_transform = BatchCompose([
+        BatchRandomTimeShift(1.0),
+        BatchRandomTimeResize(p=0.5),
+        BatchMasking(10, 2),
+        BatchMasking(8, 1),
+    ])
+
+    batches = [
+        [
+            t.rand(n_mels, int(t.randint(min_frames, max_frames + 1, (1,))))
+            for _ in range(batch_size)
+        ]
+        for _ in range(n_batches)
+    ]
+
+    with t.no_grad():
+        start_time = time.perf_counter()
+        for mel_specs in batches:
+            pad([transform(x) for x in mel_specs])
+        sample_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for mel_specs in batches:
+            batch_transform(*pad(mel_specs))
+        batch_seconds = time.perf_counter() - start_time
+
+    print(f'Per-sample: {sample_seconds / n_batches * 1000:.1f} ms/batch')
+    print(f'Batch:      {batch_seconds / n_batches * 1000:.1f} ms/batch')
+    print(f'Speedup:    {sample_seconds / batch_seconds:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
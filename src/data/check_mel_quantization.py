@@ -0,0 +1,57 @@
+'''
+Check accuracy of quantized mel spectrogram storage.
+
+Mel spectrograms of a random sample of parts stored in float32 are quantized with each
+dtype, restored and passed through Collate. The result is compared with Collate output
+for the original float32 spectrograms.
+'''
+import click
+import numpy as np
+import pandas as pd
+import torch as t
+from tqdm import tqdm
+from src.data.dataset import BirdMelTrainDataset
+from src.data.mel_store import MEL_DTYPES, dequantize_mel_spec, quantize_mel_spec
+from src.models.simple_cnn.model import Collate
+
+
+@click.command()
+@click.argument('meta_path', type=click.Path())
+@click.argument('mels_dir', type=click.Path())
+@click.option('--storage', type=click.Choice(['pt', 'shards']), default='pt')
+@click.option('--n_samples', default=200)
+@click.option('--n_frames', default=256)
+@click.option('--min_log', default=-9.2103)
+@click.option('--max_log', default=13.1293)
+def main(meta_path, mels_dir, storage, n_samples, n_frames, min_log, max_log):
+    df = pd.read_csv(meta_path)
+    df = df.sample(min(n_samples, len(df)), random_state=123)
+    dataset = BirdMelTrainDataset(df, mels_dir, True, storage=storage)
+    collate = Collate(n_frames, min_log, max_log)
+
+    max_errors = {dtype: 0. for dtype in MEL_DTYPES[1:]}
+    sum_errors = {dtype: 0. for dtype in MEL_DTYPES[1:]}
+    n_values = 0
+
+    with t.no_grad():
+        for i in tqdm(range(len(dataset))):
+            sample = dataset[i]
+            reference = collate([sample])['mel_specs']
+            n_values += reference.numel()
+            for dtype in MEL_DTYPES[1:]:
+                data, scale, offset = quantize_mel_spec(sample['mel_spec'], dtype)
+                quantized_sample = sample.copy()
+                quantized_sample['mel_spec'] = dequantize_mel_spec(data, scale, offset)
+                error = (collate([quantized_sample])['mel_specs'] - reference).abs()
+                max_errors[dtype] = max(max_errors[dtype], error.max().item())
+                sum_errors[dtype] += error.sum().item()
+
+    print('dtype   | size | max abs error | mean abs error')
+    for dtype in MEL_DTYPES[1:]:
+        size = np.dtype(dtype).itemsize / 4
+        print(f'{dtype:<7} | {size:.2f} | {max_errors[dtype]:.6f} | '
+              f'{sum_errors[dtype] / n_values:.6f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import torchaudio as toa
 import torch as t
 from tqdm import tqdm
 from pathlib import Path
+from src.data.transform_cache import get_resample_transform
 
 
 @click.command()
@@ -22,7 +23,6 @@ def main(input_dir, output_dir, resample_rate, n_fft, n_mels, hop_length, use_on
 
     f_paths = Path(input_dir).rglob('*.mp3')
 
-    resample_transforms = {}
     mel_transform = toa.transforms.MelSpectrogram(
         sample_rate=resample_rate,
         n_fft=n_fft,
@@ -41,13 +41,7 @@ def main(input_dir, output_dir, resample_rate, n_fft, n_mels, hop_length, use_on
         waveform = waveform[0]
 
         with t.no_grad():
-            if old_sampling_rate not in resample_transforms:
-                resample_transforms[old_sampling_rate] = toa.transforms.Resample(
-                    old_sampling_rate,
-                    resample_rate
-                )
-
-            resample_transform = resample_transforms[old_sampling_rate]
+            resample_transform = get_resample_transform(old_sampling_rate, resample_rate)
             waveform = resample_transform(waveform)
             mel_spec = mel_transform(waveform)
 
@@ -1,8 +1,16 @@
 import os
-from torch.utils.data import Dataset
+import numpy as np
+import pandas as pd
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import torch as t
 import torchaudio as toa
 from ast import literal_eval
+from src.data.mel_store import mel_key, open_mel_store
+from src.data.transform_cache import get_resample_transform, get_mel_transform
+from src.data.waveform_store import WaveformStore
+from src.data.streaming import (
+    open_audio_stream, iter_resampled_chunks, iter_mel_chunks, iter_mel_windows
+)
 
 
 INDEX_TO_EBIRD_CODE = [
@@ -327,59 +335,142 @@ EBIRD_CODE_TO_LABEL = {
 LABEL_TO_EBIRD_CODE = {v: k for k, v in EBIRD_CODE_TO_LABEL.items()}
 
 
-class BirdMelTrainDataset(Dataset):
-    '''Mel spectrogram train dataset.'''
-    def __init__(self, meta_df, mels_dir, encode_secondary_labels, transform=None):
-        self.meta_df = meta_df
-        self.mels_dir = mels_dir
-        self.encode_secondary_labels = encode_secondary_labels
-        self.transform = transform
+class PackedStrings:
+    '''
+    Strings kept as one utf-8 buffer and offsets, so a dataset holding them is pickled to
+    DataLoader workers as two arrays instead of one Python object per row.
+    '''
+    def __init__(self, values):
+        encoded = [x.encode('utf-8') for x in values]
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(x) for x in encoded])
 
     def __len__(self):
-        return len(self.meta_df)
+        return len(self.offsets) - 1
 
     def __getitem__(self, i):
-        filename = os.path.splitext(self.meta_df['filename'].values[i])[0] + '.pt'
-        primary_ebird_code = self.meta_df['ebird_code'].values[i]
-        filepath = os.path.join(self.mels_dir, primary_ebird_code, filename)
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+
+class LabelIndex:
+    '''
+    Labels of meta_df rows parsed once into compact arrays.
+    Secondary labels are kept CSR-style: labels of row i are
+    label_vocabulary[label_indices[label_indptr[i]:label_indptr[i + 1]]].
+    Encoded ebird codes of all rows are kept as a bit-packed multi-hot matrix.
+    '''
+    def __init__(self, meta_df, encode_secondary_labels):
+        self.primary_indices = np.array(
+            [EBIRD_CODE_TO_INDEX[x] for x in meta_df['ebird_code'].values], dtype=np.int16
+        )
+
+        vocabulary = {}
+        label_indptr = [0]
+        label_indices = []
+        for secondary_labels in meta_df['secondary_labels'].values:
+            for secondary_label in literal_eval(secondary_labels):
+                label_indices.append(vocabulary.setdefault(secondary_label, len(vocabulary)))
+            label_indptr.append(len(label_indices))
+
+        self.label_vocabulary = np.array(list(vocabulary), dtype=object)
+        self.label_indptr = np.array(label_indptr, dtype=np.int64)
+        self.label_indices = np.array(label_indices, dtype=np.int32)
+        # Index of ebird code of each vocabulary label, -1 for labels outside of the 264 classes
+        self.vocabulary_ebird_indices = np.array(
+            [
+                EBIRD_CODE_TO_INDEX[LABEL_TO_EBIRD_CODE[x]] if x in LABEL_TO_EBIRD_CODE else -1
+                for x in self.label_vocabulary
+            ],
+            dtype=np.int16
+        )
 
-        mel_spec = t.load(filepath)
+        encoded = np.zeros((len(meta_df), len(INDEX_TO_EBIRD_CODE)), dtype=np.uint8)
+        encoded[np.arange(len(meta_df)), self.primary_indices] = 1
+        if encode_secondary_labels:
+            rows = np.repeat(np.arange(len(meta_df)), np.diff(self.label_indptr))
+            ebird_indices = self.vocabulary_ebird_indices[self.label_indices]
+            known = ebird_indices >= 0
+            encoded[rows[known], ebird_indices[known]] = 1
+        self.packed_encoded = np.packbits(encoded, axis=1)
 
-        primary_label = self.meta_df['primary_label'].values[i]
-        secondary_labels = literal_eval(self.meta_df['secondary_labels'].values[i])
-        duration = self.meta_df['duration'].values[i]
-        rating = self.meta_df['rating'].values[i]
+    def secondary_labels(self, i):
+        indices = self.label_indices[self.label_indptr[i]:self.label_indptr[i + 1]]
+        return list(self.label_vocabulary[indices])
+
+    def secondary_ebird_codes(self, i):
+        indices = self.label_indices[self.label_indptr[i]:self.label_indptr[i + 1]]
+        return [
+            INDEX_TO_EBIRD_CODE[x] for x in self.vocabulary_ebird_indices[indices] if x >= 0
+        ]
+
+    def encoded_ebird_codes(self, i):
+        encoded = np.unpackbits(self.packed_encoded[i], count=len(INDEX_TO_EBIRD_CODE))
+        return t.from_numpy(encoded.astype(np.float32))
+
+
+class BirdMelTrainDataset(Dataset):
+    '''
+    Mel spectrogram train dataset.
+    storage: "pt" to read separate .pt files or "shards" to read packed memory-mapped shards.
+    crop_frames: if set, a random window of crop_frames frames is read instead of the whole
+    spectrogram (only the window is read from shards), shorter spectrograms are repeated.
+    mel_cache: SharedMelCache (see src/data/mel_cache.py) used instead of opening the store,
+    it can be shared by several datasets.
+    meta_df is parsed once into arrays, so items are read without pandas or label parsing
+    and the dataset is cheap to send to DataLoader workers.
+    '''
+    data_key = 'mel_spec'
+    length_column = 'n_frames'
+
+    def __init__(self, meta_df, mels_dir, encode_secondary_labels, transform=None,
+                 storage='pt', crop_frames=None, mel_cache=None):
+        self.mels_dir = mels_dir
+        self.encode_secondary_labels = encode_secondary_labels
+        self.transform = transform
+        self.crop_frames = crop_frames
+        if mel_cache is not None:
+            self.mel_store = mel_cache
+        else:
+            self.mel_store = self.open_store(mels_dir, storage)
 
-        secondary_ebird_codes = []
-        for secondary_label in secondary_labels:
-            if secondary_label in LABEL_TO_EBIRD_CODE:
-                secondary_ebird_code = LABEL_TO_EBIRD_CODE[secondary_label]
-                secondary_ebird_codes.append(secondary_ebird_code)
+        self.keys = PackedStrings(
+            mel_key(ebird_code, filename)
+            for ebird_code, filename in zip(meta_df['ebird_code'], meta_df['filename'])
+        )
+        self.primary_labels = PackedStrings(meta_df['primary_label'].values)
+        self.durations = meta_df['duration'].values
+        self.ratings = meta_df['rating'].values
+        self.labels = LabelIndex(meta_df, encode_secondary_labels)
+        # Frame (or sample) counts written to train.csv by prepare_data.py
+        if self.length_column in meta_df:
+            self.lengths = meta_df[self.length_column].values.astype(np.int64)
+        else:
+            self.lengths = None
 
-        primary_label_indices = []
-        primary_label_indices.append(EBIRD_CODE_TO_INDEX[primary_ebird_code])
-        primary_label_indices = t.LongTensor(primary_label_indices)
+    def open_store(self, mels_dir, storage):
+        return open_mel_store(mels_dir, storage)
 
-        encoded_ebird_codes = t.zeros((len(INDEX_TO_EBIRD_CODE),))
-        encoded_ebird_codes.scatter_(0, primary_label_indices, 1)
+    def __len__(self):
+        return len(self.keys)
 
-        if self.encode_secondary_labels:
-            secondary_label_indices = []
-            for secondary_ebird_code in secondary_ebird_codes:
-                secondary_label_indices.append(EBIRD_CODE_TO_INDEX[secondary_ebird_code])
-            secondary_label_indices = t.LongTensor(secondary_label_indices)
-            encoded_ebird_codes.scatter_(0, secondary_label_indices, 1)
+    def __getitem__(self, i):
+        key = self.keys[i]
+        if self.crop_frames is None:
+            mel_spec = self.mel_store.load(key)
+        else:
+            mel_spec = self.load_crop(i, key)
 
         sample = {
-            'mel_spec': mel_spec,
-            'primary_ebird_code': primary_ebird_code,
-            'secondary_ebird_codes': secondary_ebird_codes,
-            'encoded_ebird_codes': encoded_ebird_codes,
-            'primary_label': primary_label,
-            'secondary_labels': secondary_labels,
-            'duration': duration,
-            'filepath': filepath,
-            'rating': rating,
+            self.data_key: mel_spec,
+            'primary_ebird_code': INDEX_TO_EBIRD_CODE[self.labels.primary_indices[i]],
+            'secondary_ebird_codes': self.labels.secondary_ebird_codes(i),
+            'encoded_ebird_codes': self.labels.encoded_ebird_codes(i),
+            'primary_label': self.primary_labels[i],
+            'secondary_labels': self.labels.secondary_labels(i),
+            'duration': self.durations[i],
+            'filepath': self.mel_store.path(key),
+            'rating': self.ratings[i],
         }
 
         if self.transform is not None:
@@ -387,13 +478,76 @@ class BirdMelTrainDataset(Dataset):
 
         return sample
 
+    def load_crop(self, i, key):
+        '''Crop along the last dimension, so it works for waveforms too.'''
+        if self.lengths is not None:
+            n_frames = int(self.lengths[i])
+        else:
+            n_frames = self.mel_store.n_frames_of(key)
+
+        if n_frames is None:
+            mel_spec = self.mel_store.load(key)
+            n_frames = mel_spec.size(-1)
+            start = np.random.randint(0, max(n_frames - self.crop_frames, 0) + 1)
+            mel_spec = mel_spec[..., start:start + self.crop_frames]
+        else:
+            start = np.random.randint(0, max(n_frames - self.crop_frames, 0) + 1)
+            mel_spec = self.mel_store.load(key, start, self.crop_frames)
+
+        if mel_spec.size(-1) < self.crop_frames:
+            k = int(np.ceil(self.crop_frames / mel_spec.size(-1)))
+            repeats = [1] * (mel_spec.dim() - 1) + [k]
+            mel_spec = mel_spec.repeat(*repeats)[..., :self.crop_frames]
+        return mel_spec
+
+
+class BirdWaveformTrainDataset(BirdMelTrainDataset):
+    '''
+    Train dataset of resampled int16 waveforms saved by prepare_data.py --save_waveforms.
+    Samples have "waveform" instead of "mel_spec", crop_frames is a number of samples.
+    '''
+    data_key = 'waveform'
+    length_column = 'n_samples'
+
+    def __init__(self, meta_df, data_dir, encode_secondary_labels, transform=None,
+                 crop_samples=None):
+        super().__init__(
+            meta_df, data_dir, encode_secondary_labels, transform, crop_frames=crop_samples
+        )
+
+    def open_store(self, data_dir, storage):
+        return WaveformStore(data_dir)
+
+
+class RecordingRows:
+    '''
+    Rows of test meta_df grouped by audio_id once, instead of filtering meta_df for every
+    recording. Recordings keep the order of meta_df['audio_id'].unique(), rows keep their
+    order within a recording.
+    '''
+    def __init__(self, meta_df):
+        codes, audio_ids = pd.factorize(meta_df['audio_id'])
+        self.audio_ids = np.asarray(audio_ids)
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(self.audio_ids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.row_ids = meta_df['row_id'].values[order]
+        self.seconds = meta_df['seconds'].values[order].astype(np.float64)
+        self.sites = meta_df['site'].values[order]
+
+    def __len__(self):
+        return len(self.audio_ids)
+
+    def rows(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
 
 class BirdMelTestDataset(Dataset):
     '''Test audio dataset with mel spectrogram transformation.'''
     def __init__(self, meta_df, audio_dir, target_sampling_rate=None):
-        self.meta_df = meta_df
         self.audio_dir = audio_dir
-        self.audio_ids = self.meta_df['audio_id'].unique()
+        self.recordings = RecordingRows(meta_df)
+        self.audio_ids = self.recordings.audio_ids
         self.target_sampling_rate = target_sampling_rate
 
     def __len__(self):
@@ -403,15 +557,15 @@ class BirdMelTestDataset(Dataset):
 
         audio_id = self.audio_ids[i]
 
-        df = self.meta_df[self.meta_df['audio_id'] == audio_id]
-        site = df['site'].values[0]
-        row_ids = list(df['row_id'].values)
+        rows = self.recordings.rows(i)
+        site = self.recordings.sites[rows][0]
+        row_ids = list(self.recordings.row_ids[rows])
 
         start_seconds = []
         end_seconds = []
         durations = []
         current_seconds = 0
-        for seconds in df['seconds'].values:
+        for seconds in self.recordings.seconds[rows]:
             start_seconds.append(current_seconds)
             end_seconds.append(seconds)
             durations.append(seconds - current_seconds)
@@ -421,7 +575,7 @@ class BirdMelTestDataset(Dataset):
 
         waveform, old_sampling_rate = toa.load(filepath)
         if self.target_sampling_rate is not None:
-            resample_transform = toa.transforms.Resample(
+            resample_transform = get_resample_transform(
                 old_sampling_rate,
                 self.target_sampling_rate
             )
@@ -432,12 +586,7 @@ class BirdMelTestDataset(Dataset):
 
         channels = waveform.size(0)
 
-        mel_transform = toa.transforms.MelSpectrogram(
-            sample_rate=sampling_rate,
-            n_fft=2048,
-            n_mels=128,
-            hop_length=512,
-        )
+        mel_transform = get_mel_transform(sampling_rate, 2048, 128, 512)
 
         mel_spec = mel_transform(waveform)
 
@@ -455,3 +604,83 @@ class BirdMelTestDataset(Dataset):
             'filepath': filepath,
             'channels': channels,
         }
+
+
+class BirdMelTestStreamDataset(IterableDataset):
+    '''
+    Streaming version of BirdMelTestDataset.
+    Recordings are decoded, resampled and transformed in chunks of chunk_duration seconds and
+    one item with the mel spectrogram window of each row_id is yielded, so memory used by
+    a worker does not depend on recording length.
+    '''
+    def __init__(self, meta_df, audio_dir, target_sampling_rate=None, chunk_duration=10,
+                 n_fft=2048, n_mels=128, hop_length=512):
+        self.audio_dir = audio_dir
+        self.recordings = RecordingRows(meta_df)
+        self.audio_ids = self.recordings.audio_ids
+        self.target_sampling_rate = target_sampling_rate
+        self.chunk_duration = chunk_duration
+        self.n_fft = n_fft
+        self.n_mels = n_mels
+        self.hop_length = hop_length
+
+    def __iter__(self):
+        indices = range(len(self.audio_ids))
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            indices = indices[worker_info.id::worker_info.num_workers]
+
+        for i in indices:
+            yield from self.iter_recording(i)
+
+    def iter_recording(self, i):
+        audio_id = self.audio_ids[i]
+        row_slice = self.recordings.rows(i)
+        site = self.recordings.sites[row_slice][0]
+        filepath = os.path.join(self.audio_dir, f'{audio_id}.mp3')
+
+        old_sampling_rate, chunks = open_audio_stream(filepath, self.chunk_duration)
+        if self.target_sampling_rate is not None:
+            chunks = iter_resampled_chunks(chunks, old_sampling_rate, self.target_sampling_rate)
+            sampling_rate = self.target_sampling_rate
+        else:
+            sampling_rate = old_sampling_rate
+        mel_chunks = iter_mel_chunks(
+            chunks, sampling_rate, self.n_fft, self.n_mels, self.hop_length
+        )
+
+        # Rows without seconds cover the whole recording
+        rows = []
+        current_seconds = 0
+        row_ids = self.recordings.row_ids[row_slice]
+        for row_id, seconds in zip(row_ids, self.recordings.seconds[row_slice]):
+            if np.isnan(seconds):
+                rows.append((row_id, 0, None))
+            else:
+                rows.append((row_id, current_seconds, seconds))
+                current_seconds = seconds
+        rows = sorted(rows, key=lambda x: x[1])
+
+        frames_per_second = sampling_rate / self.hop_length
+        frame_ranges = [
+            (
+                int(start_seconds * frames_per_second),
+                None if end_seconds is None else int(end_seconds * frames_per_second)
+            )
+            for _, start_seconds, end_seconds in rows
+        ]
+
+        mel_windows = iter_mel_windows(mel_chunks, frame_ranges)
+        for (row_id, start_seconds, end_seconds), mel_spec in zip(rows, mel_windows):
+            yield {
+                'mel_spec': mel_spec,
+                'old_sampling_rate': old_sampling_rate,
+                'sampling_rate': sampling_rate,
+                'site': site,
+                'audio_id': audio_id,
+                'row_id': row_id,
+                'start_seconds': start_seconds,
+                'end_seconds': end_seconds,
+                'filepath': filepath,
+                'channels': None if mel_spec is None else mel_spec.size(0),
+            }
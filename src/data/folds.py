@@ -0,0 +1,72 @@
+'''
+Group-aware species-stratified folds of train.csv.
+
+Parts of the same recording (group_id) always land in the same fold, and the groups of
+every species are spread evenly across folds. Folds are cached next to the csv in
+folds_<sha1 of the csv>_<n_folds>_<seed>.csv, so all experiments with the same data and
+seed share identical splits.
+'''
+import os
+import click
+import numpy as np
+import pandas as pd
+from src.data.manifest import file_fingerprint
+
+
+def build_group_folds(df, n_folds=5, seed=123):
+    '''Returns DataFrame with group_id and fold columns, one row per group.'''
+    rng = np.random.RandomState(seed)
+    # Species of a group is the species of its first part
+    groups = df.drop_duplicates('group_id')[['group_id', 'ebird_code']]
+    groups = groups.iloc[rng.permutation(len(groups))]
+    groups = groups.sort_values('ebird_code', kind='mergesort')
+
+    rank = groups.groupby('ebird_code').cumcount().values
+    species_codes, species = pd.factorize(groups['ebird_code'])
+    # Random starting fold per species, so species with few groups do not all start in fold 0
+    species_offsets = rng.randint(0, n_folds, size=len(species))
+
+    return pd.DataFrame({
+        'group_id': groups['group_id'].values,
+        'fold': (rank + species_offsets[species_codes]) % n_folds,
+    })
+
+
+def folds_path(meta_path, n_folds, seed):
+    sha1 = file_fingerprint(meta_path, use_hash=True)['sha1']
+    return os.path.join(
+        os.path.dirname(meta_path), f'folds_{sha1[:16]}_{n_folds}_{seed}.csv'
+    )
+
+
+def load_folds(meta_path, df=None, n_folds=5, seed=123):
+    '''Fold of every row of the csv, built and cached on first use.'''
+    if df is None:
+        df = pd.read_csv(meta_path)
+    path = folds_path(meta_path, n_folds, seed)
+    if os.path.exists(path):
+        folds = pd.read_csv(path)
+    else:
+        folds = build_group_folds(df, n_folds, seed)
+        folds.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    return df['group_id'].map(folds.set_index('group_id')['fold']).values
+
+
+@click.command()
+@click.argument('meta_path', type=click.Path(exists=True))
+@click.option('--n_folds', default=5)
+@click.option('--seed', default=123)
+def main(meta_path, n_folds, seed):
+    df = pd.read_csv(meta_path)
+    df['fold'] = load_folds(meta_path, df, n_folds, seed)
+    print(f'Saved to {folds_path(meta_path, n_folds, seed)}')
+    print(df.groupby('fold').agg(
+        parts=('group_id', 'size'),
+        groups=('group_id', 'nunique'),
+        species=('ebird_code', 'nunique')
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''
+Manifest of processed source recordings.
+
+One JSON line per processed recording is appended to <output_dir>/manifest.jsonl:
+source path, fingerprint (size and mtime or sha1 of the content), processing parameters
+and produced parts with their frame counts. Later lines override earlier ones, so the file
+is append-only and a crashed run keeps the record of everything that was finished.
+
+When preprocessing is split between nodes, shard i of n writes
+<output_dir>/manifest_<i>_of_<n>.jsonl instead.
+'''
+import os
+import json
+import zlib
+import hashlib
+from glob import glob
+
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+
+def manifest_filename(shard=None):
+    '''shard: (i, n) or None.'''
+    if shard is None:
+        return MANIFEST_FILENAME
+    return f'manifest_{shard[0]}_of_{shard[1]}.jsonl'
+
+
+def source_shard(source, n_shards):
+    '''Shard of a source path, stable between runs and machines.'''
+    return zlib.crc32(source.encode('utf-8')) % n_shards
+
+
+def file_fingerprint(f_path, use_hash=False):
+    stat = os.stat(f_path)
+    fingerprint = {'size': stat.st_size}
+    if use_hash:
+        sha1 = hashlib.sha1()
+        with open(f_path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                sha1.update(block)
+        fingerprint['sha1'] = sha1.hexdigest()
+    else:
+        fingerprint['mtime'] = stat.st_mtime
+    return fingerprint
+
+
+def read_manifest(manifest_path):
+    '''Returns {source: entry} with the latest entry for each source.'''
+    manifest = {}
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line may be cut off by a crash
+                continue
+            manifest[entry['source']] = entry
+    return manifest
+
+
+def read_manifests(output_dir):
+    '''
+    Read the manifest together with manifests of all shards.
+    The most recently processed entry is used for each source.
+    '''
+    manifest = read_manifest(os.path.join(output_dir, MANIFEST_FILENAME))
+    for path in sorted(glob(os.path.join(output_dir, 'manifest_*_of_*.jsonl'))):
+        for source, entry in read_manifest(path).items():
+            if source not in manifest or (
+                entry.get('processed_at', 0) >= manifest[source].get('processed_at', 0)
+            ):
+                manifest[source] = entry
+    return manifest
+
+
+def append_manifest(manifest_path, entries):
+    with open(manifest_path, 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def is_up_to_date(entry, fingerprint, params):
+    if entry is None:
+        return False
+    return entry['fingerprint'] == fingerprint and entry['params'] == params
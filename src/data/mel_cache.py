@@ -0,0 +1,172 @@
+'''
+Cache of decoded mel spectrograms shared by all DataLoader workers.
+
+Spectrograms are kept in a shared memory arena of small blocks of block_frames frames.
+A spectrogram takes as many blocks as it needs, chained through a block table, so
+variable-length spectrograms waste less than a block each instead of being padded to the
+longest one. The arena and the tables are allocated before the workers are started, so
+every worker sees the spectrograms loaded by the others. When the arena is full the least
+recently used spectrograms are evicted.
+'''
+import math
+import torch as t
+import torch.nn.functional as F
+import multiprocessing as mp
+
+
+HITS = 0
+MISSES = 1
+EVICTIONS = 2
+CLOCK = 3
+N_FREE = 4
+
+
+class SharedMelCache:
+    '''
+    Wraps a mel store (see src/data/mel_store.py) and has the same interface.
+    keys: keys that may be cached, other keys are read from the store directly.
+    budget: size of the arena in bytes.
+    Whole spectrograms are cached and windows requested with start/n_frames are cut from
+    them. A missed window is read alone from the store once the arena is full, so crops of
+    uncached spectrograms do not read whole files only to evict other spectrograms.
+    '''
+    def __init__(self, mel_store, keys, budget, n_mels=None, block_frames=32):
+        self.mel_store = mel_store
+        self.positions = {key: i for i, key in enumerate(dict.fromkeys(keys))}
+        if n_mels is None:
+            n_mels = mel_store.load(next(iter(self.positions)), 0, 1).size(0)
+        self.n_mels = n_mels
+        self.block_frames = block_frames
+        self.budget = budget
+        self.n_blocks = int(budget // (n_mels * block_frames * 4))
+        n_items = len(self.positions)
+
+        self.arena = t.empty(self.n_blocks, n_mels, block_frames).share_memory_()
+        # Next block of the same spectrogram, -1 for the last one
+        self.block_next = t.full((self.n_blocks,), -1, dtype=t.int64).share_memory_()
+        # Stack of free blocks, its size is counters[N_FREE]
+        self.free_blocks = t.arange(self.n_blocks, dtype=t.int64).share_memory_()
+        self.item_first = t.full((n_items,), -1, dtype=t.int64).share_memory_()
+        self.item_lengths = t.zeros(n_items, dtype=t.int64).share_memory_()
+        self.item_ticks = t.zeros(n_items, dtype=t.int64).share_memory_()
+        self.counters = t.zeros(5, dtype=t.int64).share_memory_()
+        self.counters[N_FREE] = self.n_blocks
+        self.lock = mp.Lock()
+
+    def path(self, key):
+        return self.mel_store.path(key)
+
+    def n_frames_of(self, key):
+        return self.mel_store.n_frames_of(key)
+
+    def load(self, key, start=0, n_frames=None):
+        i = self.positions.get(key)
+        if i is None or self.n_blocks == 0:
+            return self.mel_store.load(key, start, n_frames)
+
+        with self.lock:
+            if self.item_first[i] >= 0:
+                self.counters[HITS] += 1
+                self.counters[CLOCK] += 1
+                self.item_ticks[i] = self.counters[CLOCK]
+                return self.read(i, start, n_frames)
+            self.counters[MISSES] += 1
+            is_window = start > 0 or n_frames is not None
+            fill = not is_window or int(self.counters[N_FREE]) > 0
+
+        # Store is read without holding the lock
+        if not fill:
+            return self.mel_store.load(key, start, n_frames)
+        mel_spec = self.mel_store.load(key)
+        # Only whole spectrogram reads make room by evicting others
+        self.insert(i, mel_spec, evict=not is_window)
+        return mel_spec[:, window(start, n_frames, mel_spec.size(1))]
+
+    def chain(self, first, n=None):
+        '''First n blocks (all if None) of the chain starting at block first.'''
+        block_next = self.block_next.numpy()
+        blocks = []
+        block = first
+        while block >= 0 and (n is None or len(blocks) < n):
+            blocks.append(block)
+            block = int(block_next[block])
+        return blocks
+
+    def read(self, i, start, n_frames):
+        '''Called with the lock held.'''
+        frames = window(start, n_frames, int(self.item_lengths[i]))
+        if frames.stop <= frames.start:
+            return self.arena.new_zeros(self.n_mels, 0)
+        first_block = frames.start // self.block_frames
+        last_block = (frames.stop - 1) // self.block_frames
+        blocks = self.chain(int(self.item_first[i]), last_block + 1)[first_block:]
+        data = self.arena[t.LongTensor(blocks)].permute(1, 0, 2).reshape(self.n_mels, -1)
+        offset = first_block * self.block_frames
+        return data[:, frames.start - offset:frames.stop - offset]
+
+    def insert(self, i, mel_spec, evict=True):
+        length = mel_spec.size(1)
+        n = math.ceil(length / self.block_frames)
+        if mel_spec.size(0) != self.n_mels or n == 0 or n > self.n_blocks:
+            return
+        with self.lock:
+            if self.item_first[i] >= 0:
+                # Loaded by another worker in the meantime
+                return
+            if int(self.counters[N_FREE]) < n and not evict:
+                return
+            while int(self.counters[N_FREE]) < n:
+                self.evict_lru()
+
+            n_free = int(self.counters[N_FREE])
+            blocks = self.free_blocks[n_free - n:n_free].clone()
+            self.counters[N_FREE] = n_free - n
+
+            padded = F.pad(mel_spec, (0, n * self.block_frames - length))
+            self.arena[blocks] = padded.view(self.n_mels, n, self.block_frames).permute(1, 0, 2)
+            self.block_next[blocks[:-1]] = blocks[1:]
+            self.block_next[blocks[-1]] = -1
+            self.item_first[i] = blocks[0]
+            self.item_lengths[i] = length
+            self.counters[CLOCK] += 1
+            self.item_ticks[i] = self.counters[CLOCK]
+
+    def evict_lru(self):
+        '''Called with the lock held.'''
+        cached = self.item_first >= 0
+        ticks = t.where(cached, self.item_ticks, t.full_like(self.item_ticks, 2 ** 62))
+        i = int(t.argmin(ticks))
+        blocks = self.chain(int(self.item_first[i]))
+        n_free = int(self.counters[N_FREE])
+        self.free_blocks[n_free:n_free + len(blocks)] = t.LongTensor(blocks)
+        self.counters[N_FREE] = n_free + len(blocks)
+        self.item_first[i] = -1
+        self.counters[EVICTIONS] += 1
+
+    def stats(self):
+        '''Counters are shared, so they include reads of all workers.'''
+        with self.lock:
+            hits, misses, evictions, _, n_free = self.counters.tolist()
+            cached = self.item_first >= 0
+            n_cached = int(cached.sum())
+            cached_frames = int(self.item_lengths[cached].sum())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': hits / max(hits + misses, 1),
+            'n_cached': n_cached,
+            'n_blocks': self.n_blocks,
+            'n_free_blocks': n_free,
+            'n_keys': len(self.positions),
+            # Bytes of spectrograms in the cache, less than the arena because of partly
+            # filled last blocks
+            'cached_bytes': cached_frames * self.n_mels * 4,
+            'budget': self.budget,
+        }
+
+
+def window(start, n_frames, length):
+    start = min(start, length)
+    end = length if n_frames is None else min(start + n_frames, length)
+    return slice(start, end)
@@ -0,0 +1,139 @@
+'''
+Statistics of log mel spectrograms used for normalization.
+
+Per-part statistics (min/max, per mel bin sums and sums of squares, histogram) are computed
+by prepare_data.py workers and appended to <output_dir>/part_stats.jsonl, one line per part
+keyed like the mel store, so the manifest stays small. They are merged into global statistics,
+so training does not need to scan the dataset:
+
+mel_stats.json                  - all parts, e.g. for models trained on all data
+mel_stats_fold_<k>_of_<n>.json  - parts outside validation fold k (see src/data/folds.py),
+                                  so the validation fold is normalized with train statistics
+'''
+import os
+import json
+import numpy as np
+import torch as t
+from glob import glob
+from src.data.mel_store import LOG_EPS
+
+
+MEL_STATS_FILENAME = 'mel_stats.json'
+PART_STATS_FILENAME = 'part_stats.jsonl'
+# prepare_data.py parameters the statistics depend on, recorded as mel_params
+MEL_PARAM_NAMES = ['target_sampling_rate', 'n_fft', 'n_mels', 'hop_length']
+HIST_BINS = 100
+HIST_MIN = -20.
+HIST_MAX = 20.
+
+
+def compute_mel_stats(mel_spec):
+    log_mel_spec = t.log(mel_spec.double() + LOG_EPS)
+    histogram = t.histc(
+        log_mel_spec.clamp(HIST_MIN, HIST_MAX).float(),
+        bins=HIST_BINS,
+        min=HIST_MIN,
+        max=HIST_MAX
+    )
+    return {
+        'n_frames': log_mel_spec.size(1),
+        'min_log': log_mel_spec.min().item(),
+        'max_log': log_mel_spec.max().item(),
+        'sum': log_mel_spec.sum(dim=1).tolist(),
+        'sum_sq': (log_mel_spec ** 2).sum(dim=1).tolist(),
+        'histogram': [int(x) for x in histogram.tolist()],
+    }
+
+
+def merge_mel_stats(stats_list):
+    '''Merge per-part statistics into global statistics.'''
+    n_frames = 0
+    min_log = np.inf
+    max_log = -np.inf
+    sums = 0.
+    sums_sq = 0.
+    histogram = np.zeros(HIST_BINS, dtype=np.int64)
+
+    for stats in stats_list:
+        n_frames += stats['n_frames']
+        min_log = min(min_log, stats['min_log'])
+        max_log = max(max_log, stats['max_log'])
+        sums = sums + np.array(stats['sum'])
+        sums_sq = sums_sq + np.array(stats['sum_sq'])
+        histogram += np.array(stats['histogram'], dtype=np.int64)
+
+    mean = sums / max(n_frames, 1)
+    std = np.sqrt(np.maximum(sums_sq / max(n_frames, 1) - mean ** 2, 0.))
+
+    return {
+        'n_frames': int(n_frames),
+        'min_log': float(min_log),
+        'max_log': float(max_log),
+        'mean': np.atleast_1d(mean).tolist(),
+        'std': np.atleast_1d(std).tolist(),
+        'histogram': histogram.tolist(),
+        'histogram_edges': np.linspace(HIST_MIN, HIST_MAX, HIST_BINS + 1).tolist(),
+    }
+
+
+def mismatched_mel_params(mel_stats, **params):
+    '''
+    Parameters that differ from the ones the statistics were computed with, as
+    {name: (given, recorded)}. All are returned if the statistics do not record them.
+    '''
+    recorded = mel_stats.get('mel_params') or {}
+    return {
+        name: (value, recorded.get(name))
+        for name, value in params.items() if recorded.get(name) != value
+    }
+
+
+def fold_stats_filename(fold, n_folds):
+    return f'mel_stats_fold_{fold}_of_{n_folds}.json'
+
+
+def part_stats_filename(shard=None):
+    '''shard: (i, n) or None, shards write separate files like manifests.'''
+    if shard is None:
+        return PART_STATS_FILENAME
+    return f'part_stats_{shard[0]}_of_{shard[1]}.jsonl'
+
+
+def append_part_stats(path, records):
+    '''records: dicts with key, processed_at and stats of a part.'''
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_part_stats(output_dir):
+    '''Returns {key: stats} with the most recently computed statistics of each part.'''
+    paths = [os.path.join(output_dir, PART_STATS_FILENAME)]
+    paths += sorted(glob(os.path.join(output_dir, 'part_stats_*_of_*.jsonl')))
+    records = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line may be cut off by a crash
+                    continue
+                key = record['key']
+                if key not in records or record['processed_at'] >= records[key]['processed_at']:
+                    records[key] = record
+    return {key: record['stats'] for key, record in records.items()}
+
+
+def write_mel_stats(path, stats):
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2)
+
+
+def read_mel_stats(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,196 @@
+'''
+Storage backends for prepared mel spectrograms.
+
+pt:     <mels_dir>/<ebird_code>/<filename>.pt, one torch.save() pickle per part.
+shards: <mels_dir>/shards/shard_<n>.bin + <mels_dir>/shards/index.csv
+
+In the shard format mel spectrograms are stored time-major (n_frames x n_mels) and appended
+one after another to a few large contiguous files. The index maps every part to its shard,
+byte offset and shape, so a sample is read as a view of a memory-mapped shard without any
+unpickling or per-sample file opening.
+
+Both formats can store mel spectrograms quantized:
+float32: power mel spectrogram as is.
+float16: log mel spectrogram in half precision.
+uint8:   log mel spectrogram linearly quantized with per-file scale and offset.
+Quantized spectrograms are converted back to power mel spectrograms on read, so that
+log(mel_spec + LOG_EPS) in Collate gives the stored log mel spectrogram.
+'''
+import os
+import numpy as np
+import pandas as pd
+import torch as t
+
+
+SHARDS_DIR = 'shards'
+INDEX_FILENAME = 'index.csv'
+LOG_EPS = 0.0001
+MEL_DTYPES = ['float32', 'float16', 'uint8']
+
+
+def mel_key(ebird_code, filename):
+    '''Key of a part in the store, e.g. "aldfly/XC134874_part_0".'''
+    return f'{ebird_code}/{os.path.splitext(filename)[0]}'
+
+
+def quantize_mel_spec(mel_spec, dtype='float32'):
+    '''Returns quantized data, scale and offset: log_mel_spec = data * scale + offset.'''
+    if dtype == 'float32':
+        return mel_spec.float(), 1.0, 0.0
+
+    log_mel_spec = t.log(mel_spec + LOG_EPS)
+    if dtype == 'float16':
+        return log_mel_spec.half(), 1.0, 0.0
+    elif dtype == 'uint8':
+        offset = log_mel_spec.min().item()
+        scale = max(log_mel_spec.max().item() - offset, 1e-6) / 255
+        data = t.round((log_mel_spec - offset) / scale).clamp(0, 255).to(t.uint8)
+        return data, scale, offset
+    else:
+        raise ValueError(f'Unknown mel dtype: {dtype}')
+
+
+def dequantize_mel_spec(data, scale, offset):
+    '''Inverse of quantize_mel_spec(), returns power mel spectrogram.'''
+    if data.dtype == t.float32:
+        return data
+    return t.exp(data.float() * scale + offset) - LOG_EPS
+
+
+def save_mel_spec(mel_spec, f_path, dtype='float32'):
+    if dtype == 'float32':
+        t.save(mel_spec, f_path)
+    else:
+        data, scale, offset = quantize_mel_spec(mel_spec, dtype)
+        t.save({'data': data, 'scale': scale, 'offset': offset}, f_path)
+
+
+def append_to_shard(shards_dir, shard_name, mel_spec, dtype='float32'):
+    '''
+    Append mel spectrogram (n_mels x n_frames) to the end of a shard file.
+    Only one process may write to a given shard at a time.
+    Returns index entry describing where the spectrogram was written.
+    '''
+    data, scale, offset = quantize_mel_spec(mel_spec, dtype)
+    data = np.ascontiguousarray(data.numpy().T)
+    with open(os.path.join(shards_dir, shard_name), 'ab') as f:
+        f.seek(0, os.SEEK_END)
+        byte_offset = f.tell()
+        data.tofile(f)
+    return {
+        'shard': shard_name,
+        'offset': byte_offset,
+        'n_frames': data.shape[0],
+        'n_mels': data.shape[1],
+        'dtype': dtype,
+        'scale': scale,
+        'value_offset': offset,
+    }
+
+
+def write_index(shards_dir, index_entries):
+    index_df = pd.DataFrame(index_entries)
+    index_df.to_csv(os.path.join(shards_dir, INDEX_FILENAME), index=False)
+
+
+class PtMelStore:
+    '''Mel spectrograms stored as separate torch.save() files.'''
+    def __init__(self, mels_dir):
+        self.mels_dir = mels_dir
+
+    def path(self, key):
+        return os.path.join(self.mels_dir, key + '.pt')
+
+    def load(self, key, start=0, n_frames=None):
+        '''Whole file has to be loaded even if only frames [start, start + n_frames) are needed.'''
+        mel_spec = t.load(self.path(key))
+        if isinstance(mel_spec, dict):
+            data = mel_spec['data']
+            if n_frames is not None or start > 0:
+                data = data[:, start:None if n_frames is None else start + n_frames]
+            return dequantize_mel_spec(data, mel_spec['scale'], mel_spec['offset'])
+        if n_frames is not None or start > 0:
+            mel_spec = mel_spec[:, start:None if n_frames is None else start + n_frames]
+        return mel_spec
+
+    def n_frames_of(self, key):
+        return None
+
+
+class ShardMelStore:
+    '''Mel spectrograms packed into memory-mapped shards.'''
+    def __init__(self, mels_dir):
+        self.mels_dir = mels_dir
+        self.shards_dir = os.path.join(mels_dir, SHARDS_DIR)
+
+        index_df = pd.read_csv(os.path.join(self.shards_dir, INDEX_FILENAME))
+        keys = [
+            mel_key(ebird_code, filename)
+            for ebird_code, filename in zip(index_df['ebird_code'], index_df['filename'])
+        ]
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.shard_names = list(index_df['shard'].unique())
+        shard_ids = {name: i for i, name in enumerate(self.shard_names)}
+        self.shard_ids = index_df['shard'].map(shard_ids).values.astype(np.int32)
+        self.offsets = index_df['offset'].values.astype(np.int64)
+        self.n_frames = index_df['n_frames'].values.astype(np.int64)
+        self.n_mels = index_df['n_mels'].values.astype(np.int64)
+        self.dtypes = list(index_df['dtype'].values)
+        if 'scale' in index_df:
+            self.scales = index_df['scale'].values.astype(np.float32)
+            self.value_offsets = index_df['value_offset'].values.astype(np.float32)
+        else:
+            self.scales = np.ones(len(index_df), dtype=np.float32)
+            self.value_offsets = np.zeros(len(index_df), dtype=np.float32)
+
+        self.shards = {}
+
+    def __getstate__(self):
+        # Memory maps are opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def path(self, key):
+        i = self.positions[key]
+        return os.path.join(self.shards_dir, self.shard_names[self.shard_ids[i]])
+
+    def shard(self, shard_id):
+        if shard_id not in self.shards:
+            self.shards[shard_id] = np.memmap(
+                os.path.join(self.shards_dir, self.shard_names[shard_id]),
+                dtype=np.uint8,
+                mode='c'
+            )
+        return self.shards[shard_id]
+
+    def n_frames_of(self, key):
+        return int(self.n_frames[self.positions[key]])
+
+    def load(self, key, start=0, n_frames=None):
+        '''Only frames [start, start + n_frames) are read from the shard.'''
+        i = self.positions[key]
+        dtype = np.dtype(self.dtypes[i])
+        total_frames = int(self.n_frames[i])
+        n_mels = int(self.n_mels[i])
+        start = min(start, total_frames)
+        end = total_frames if n_frames is None else min(start + n_frames, total_frames)
+        frame_n_bytes = n_mels * dtype.itemsize
+        byte_start = int(self.offsets[i]) + start * frame_n_bytes
+        byte_end = int(self.offsets[i]) + end * frame_n_bytes
+        data = self.shard(int(self.shard_ids[i]))[byte_start:byte_end]
+        data = data.view(dtype).reshape((end - start, n_mels))
+        return dequantize_mel_spec(
+            t.from_numpy(data).t(),
+            float(self.scales[i]),
+            float(self.value_offsets[i])
+        )
+
+
+def open_mel_store(mels_dir, storage='pt'):
+    if storage == 'pt':
+        return PtMelStore(mels_dir)
+    elif storage == 'shards':
+        return ShardMelStore(mels_dir)
+    else:
+        raise ValueError(f'Unknown mel storage: {storage}')
@@ -0,0 +1,24 @@
+'''
+Merge results of prepare_data.py runs on several shards.
+
+Reads <output_dir>/manifest.jsonl and all <output_dir>/manifest_<i>_of_<n>.jsonl and writes
+train.csv, normalization statistics and the shards index for all processed recordings.
+'''
+import click
+from src.data.manifest import read_manifests
+from src.data.prepare_data import finalize_prepared_data
+
+
+@click.command()
+@click.argument('train_csv_path', type=click.Path())
+@click.argument('output_dir', type=click.Path())
+@click.option('--n_folds', default=5, help='Folds of the per fold normalization statistics')
+@click.option('--seed', default=123, help='Seed of the folds')
+def main(train_csv_path, output_dir, n_folds, seed):
+    manifest = read_manifests(output_dir)
+    print(f'Recordings processed: {len(manifest)}')
+    finalize_prepared_data(train_csv_path, output_dir, manifest, n_folds, seed)
+
+
+if __name__ == '__main__':
+    main()
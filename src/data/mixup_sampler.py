@@ -0,0 +1,97 @@
+'''
+Mixup partners of species that co-occur in the train data.
+
+Weight of species b as a partner of species a combines how often b is a secondary label of
+recordings of a (and the other way round) and at how many locations both were recorded,
+plus a small uniform part so every species can be mixed with any other. Partners are drawn
+from per species alias tables and then uniformly among the recordings of the partner
+species, both in O(1).
+'''
+import numpy as np
+import pandas as pd
+from src.data.dataset import EBIRD_CODE_TO_INDEX, INDEX_TO_EBIRD_CODE
+
+
+def build_alias_table(weights):
+    '''Vose's alias method for one row of non-negative weights with a positive sum.'''
+    n = len(weights)
+    probabilities = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    alias = np.arange(n, dtype=np.int32)
+    small = [i for i in range(n) if probabilities[i] < 1.]
+    large = [i for i in range(n) if probabilities[i] >= 1.]
+    while small and large:
+        i = small.pop()
+        j = large.pop()
+        alias[i] = j
+        probabilities[j] -= 1. - probabilities[i]
+        if probabilities[j] < 1.:
+            small.append(j)
+        else:
+            large.append(j)
+    # Leftovers are 1 up to rounding errors
+    probabilities[small + large] = 1.
+    return probabilities, alias
+
+
+def row_normalize(matrix):
+    sums = matrix.sum(axis=1, keepdims=True)
+    return np.divide(matrix, sums, out=np.zeros_like(matrix), where=sums > 0)
+
+
+class CooccurrencePartnerSampler:
+    '''
+    labels: LabelIndex of the dataset partners are taken from.
+    locations: location of every recording of the dataset, e.g. train.csv location column.
+    '''
+    def __init__(self, labels, locations=None, secondary_weight=1., location_weight=1.,
+                 uniform_weight=0.1):
+        n_species = len(INDEX_TO_EBIRD_CODE)
+        primary = labels.primary_indices.astype(np.int64)
+
+        # Recordings grouped by primary species
+        self.items = np.argsort(primary, kind='stable').astype(np.int64)
+        counts = np.bincount(primary, minlength=n_species)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        present = counts > 0
+
+        rows = np.repeat(primary, np.diff(labels.label_indptr))
+        secondary = labels.vocabulary_ebird_indices[labels.label_indices].astype(np.int64)
+        known = secondary >= 0
+        secondary_counts = np.zeros((n_species, n_species))
+        np.add.at(secondary_counts, (rows[known], secondary[known]), 1.)
+        secondary_counts += secondary_counts.T
+
+        location_counts = np.zeros((n_species, n_species))
+        if locations is not None:
+            location_codes, location_names = pd.factorize(pd.Series(locations))
+            recorded = np.zeros((len(location_names), n_species))
+            has_location = location_codes >= 0
+            recorded[location_codes[has_location], primary[has_location]] = 1.
+            location_counts = recorded.T @ recorded
+
+        weights = (
+            secondary_weight * row_normalize(secondary_counts)
+            + location_weight * row_normalize(location_counts)
+            + uniform_weight / n_species
+        )
+        np.fill_diagonal(weights, 0.)
+        # Only species with recordings in the dataset can be partners
+        weights[:, ~present] = 0.
+        weights[weights.sum(axis=1) == 0] = present
+
+        self.probabilities = np.zeros((n_species, n_species))
+        self.alias = np.zeros((n_species, n_species), dtype=np.int32)
+        for species in range(n_species):
+            self.probabilities[species], self.alias[species] = build_alias_table(weights[species])
+
+    def sample_species(self, species):
+        column = np.random.randint(0, len(self.alias[species]))
+        if np.random.random_sample() < self.probabilities[species, column]:
+            return column
+        return self.alias[species, column]
+
+    def sample(self, ebird_code):
+        '''Index of a mixup partner for a recording of ebird_code.'''
+        species = self.sample_species(EBIRD_CODE_TO_INDEX[ebird_code])
+        start = self.offsets[species]
+        return int(self.items[start + np.random.randint(0, self.offsets[species + 1] - start)])
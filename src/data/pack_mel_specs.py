@@ -0,0 +1,57 @@
+'''
+Pack an existing tree of .pt mel spectrograms into memory-mapped shards.
+
+<mels_dir>/<ebird_code>/*.pt -> <mels_dir>/shards/packed_<n>.bin + <mels_dir>/shards/index.csv
+
+Normalization statistics are saved to <mels_dir>/mel_stats.json as well.
+'''
+import os
+import click
+import numpy as np
+from tqdm import tqdm
+from pathlib import Path
+from src.data.mel_stats import (
+    MEL_STATS_FILENAME, compute_mel_stats, merge_mel_stats, write_mel_stats
+)
+from src.data.mel_store import (
+    MEL_DTYPES, SHARDS_DIR, PtMelStore, append_to_shard, mel_key, write_index
+)
+
+
+@click.command()
+@click.argument('mels_dir', type=click.Path())
+@click.option('--shard_size_mb', default=1024)
+@click.option('--mel_dtype', type=click.Choice(MEL_DTYPES), default='float32')
+def main(mels_dir, shard_size_mb, mel_dtype):
+    shards_dir = os.path.join(mels_dir, SHARDS_DIR)
+    Path(shards_dir).mkdir(parents=True, exist_ok=True)
+
+    f_paths = sorted(Path(mels_dir).glob('*/*.pt'))
+    store = PtMelStore(mels_dir)
+
+    index = []
+    stats = []
+    shard_n = -1
+    shard_size = shard_size_mb * 2 ** 20
+    current_size = shard_size
+
+    for f_path in tqdm(f_paths):
+        if current_size >= shard_size:
+            shard_n += 1
+            shard_name = f'packed_{shard_n:04d}.bin'
+            open(os.path.join(shards_dir, shard_name), 'wb').close()
+            current_size = 0
+
+        mel_spec = store.load(mel_key(f_path.parent.name, f_path.name))
+        part = {'ebird_code': f_path.parent.name, 'filename': f_path.name}
+        part.update(append_to_shard(shards_dir, shard_name, mel_spec, mel_dtype))
+        index.append(part)
+        stats.append(compute_mel_stats(mel_spec))
+        current_size += mel_spec.numel() * np.dtype(mel_dtype).itemsize
+
+    write_index(shards_dir, index)
+    write_mel_stats(os.path.join(mels_dir, MEL_STATS_FILENAME), merge_mel_stats(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,86 +1,293 @@
 '''
 Prepare dataset for training:
 1. Resample audio
-2. Split each recording into pieces so that each piece is shorter.
-3. Build and save mel spectrograms.
+2. Build mel spectrogram of the whole recording.
+3. Split each mel spectrogram into pieces so that each piece is shorter and save them.
 4. Create a custom train.csv file describing the new dataset.
 
 file.mp3 -> file_part_1.mp3, file_part_2.mp3, ..
+
+With --storage shards mel spectrograms are appended to packed shard files instead
+(see src/data/mel_store.py).
+
+Processed recordings are recorded in <output_dir>/manifest.jsonl (see src/data/manifest.py),
+so a rerun only processes new or changed recordings and recordings processed with
+different parameters.
+
+Recordings are processed largest first with a memory budget (see src/data/scheduler.py),
+recordings that failed are listed in <output_dir>/failures.csv.
+
+Normalization statistics of all parts and of the training folds of each validation fold are
+saved to <output_dir>/mel_stats*.json (see src/data/mel_stats.py).
+
+With --save_waveforms resampled waveforms of the same parts are saved as int16 as well
+(see src/data/waveform_store.py) for training on waveforms.
+
+Preprocessing can be split between several nodes (or processes) sharing output_dir:
+each runs with --shard i/n and writes its own manifest, then merge_prepared_data.py
+builds train.csv, mel_stats.json and the shards index from all of them:
+
+for i in 0 1 2; do python src/data/prepare_data.py ... --shard $i/3 & done; wait
+python src/data/merge_prepared_data.py <train_csv_path> <output_dir>
 '''
 
 import os
+import time
 import click
 import torch as t
 import torchaudio as toa
 import pandas as pd
 from pathlib import Path
-from joblib import Parallel, delayed
+from src.data.manifest import (
+    append_manifest, file_fingerprint, is_up_to_date, manifest_filename, read_manifests,
+    source_shard
+)
+from src.data.folds import load_folds
+from src.data.mel_store import (
+    MEL_DTYPES, SHARDS_DIR, append_to_shard, mel_key, save_mel_spec, write_index
+)
+from src.data.mel_stats import (
+    MEL_PARAM_NAMES, MEL_STATS_FILENAME, append_part_stats, compute_mel_stats, fold_stats_filename,
+    merge_mel_stats, part_stats_filename, read_part_stats, write_mel_stats
+)
+from src.data.scheduler import MemoryBoundedScheduler, PermanentError
+from src.data.transform_cache import get_mel_transform, get_resample_transform
+from src.data.waveform_store import WAVEFORMS_DIR, save_waveform_part
+
+
+# Columns of the parts frame in build_train_df, explicit so that a run without parts has them
+PART_COLUMNS = [
+    'ebird_code', 'source_filename', 'part_filename', 'part_index', 'n_frames', 'part_duration',
+    'n_samples'
+]
+
+
+def failures_filename(shard=None):
+    if shard is None:
+        return 'failures.csv'
+    return f'failures_{shard[0]}_of_{shard[1]}.csv'
 
 
 def resample_waveform(waveform, old_sampling_rate, target_sampling_rate):
-    resample_transform = toa.transforms.Resample(
-        old_sampling_rate,
-        target_sampling_rate
-    )
-    waveform = resample_transform(waveform)
+    if old_sampling_rate == target_sampling_rate:
+        return waveform
+    resample_transform = get_resample_transform(old_sampling_rate, target_sampling_rate)
+    with t.no_grad():
+        waveform = resample_transform(waveform)
     return waveform
 
 
-def split_waveform(waveform, sampling_rate=44100, max_duration=60):
-    assert len(waveform.size()) == 1  # No channels
+def split_mel_spec(mel_spec, duration_n, sampling_rate=44100, hop_length=512, max_duration=60):
+    '''
+    Split mel spectrogram of a recording of duration_n samples into pieces of at most
+    max_duration seconds. A longer recording is split into k = duration_n // max_duration_n + 1
+    pieces of duration_n // k samples, the last piece gets the rest. Piece boundaries are
+    rounded to the closest frame.
+    '''
     max_duration_n = sampling_rate * max_duration
-    duration_n = waveform.size(0)
     if duration_n <= max_duration_n:
-        waveforms = [waveform]
-    else:
-        k = duration_n // max_duration_n + 1
-        piece_duration_n = duration_n // k
-        waveforms = []
-        current_n = 0
-        for i in range(k-1):
-            waveforms.append(waveform[current_n:current_n+piece_duration_n])
-            current_n += piece_duration_n
-        waveforms.append(waveform[current_n:])
-    return waveforms
+        return [mel_spec]
+    k = duration_n // max_duration_n + 1
+    piece_duration_n = duration_n // k
+    boundaries = [round(i * piece_duration_n / hop_length) for i in range(k)]
+    boundaries.append(mel_spec.size(1))
+    # Clone so that t.save() does not store the whole recording with each piece
+    return [
+        mel_spec[:, start:end].clone()
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+    ]
 
 
 def create_mel_spec(waveform, sampling_rate, n_fft, n_mels, hop_length):
-    mel_transform = toa.transforms.MelSpectrogram(
-        sample_rate=sampling_rate,
-        n_fft=n_fft,
-        n_mels=n_mels,
-        hop_length=hop_length
-    )
-    mel_spec = mel_transform(waveform)
+    mel_transform = get_mel_transform(sampling_rate, n_fft, n_mels, hop_length)
+    with t.no_grad():
+        mel_spec = mel_transform(waveform)
     return mel_spec
 
 
 def process_file(f_path, output_dir, target_sampling_rate, max_duration,
-                 n_fft, n_mels, hop_length):
+                 n_fft, n_mels, hop_length, storage='pt', mel_dtype='float32', node=0,
+                 save_waveforms=False):
     try:
         waveform, old_sampling_rate = toa.load(f_path)
-    except RuntimeError:
-        print(f'Failed to load: {f_path}')
-        return
+    except RuntimeError as e:
+        raise PermanentError(f'Failed to load: {f_path}: {e}')
 
     waveform = waveform[0]
 
     waveform = resample_waveform(waveform, old_sampling_rate, target_sampling_rate)
-    waveforms = split_waveform(waveform, target_sampling_rate, max_duration)
-    mel_specs = [
-        create_mel_spec(x, target_sampling_rate, n_fft, n_mels, hop_length)
-        for x in waveforms
-    ]
+    # Whole recording is transformed at once and the mel spectrogram is split afterwards
+    mel_spec = create_mel_spec(waveform, target_sampling_rate, n_fft, n_mels, hop_length)
+    mel_specs = split_mel_spec(
+        mel_spec, waveform.size(0), target_sampling_rate, hop_length, max_duration
+    )
 
     f_name = os.path.basename(f_path)
     new_f_name = os.path.splitext(f_name)[0]
     ebird_code = os.path.basename(os.path.dirname(f_path))
     new_dir = os.path.join(output_dir, ebird_code)
 
+    if storage == 'shards':
+        # Each worker process of each node appends to its own shard
+        shards_dir = os.path.join(output_dir, SHARDS_DIR)
+        shard_name = f'shard_{node}_{os.getpid()}.bin'
+        Path(shards_dir).mkdir(parents=True, exist_ok=True)
+
+    parts = []
+    start_frame = 0
     for i, mel_spec in enumerate(mel_specs):
-        new_f_path = os.path.join(new_dir, f'{new_f_name}_part_{i}.pt')
-        Path(new_dir).mkdir(parents=True, exist_ok=True)
-        t.save(mel_spec, new_f_path)
+        part_f_name = f'{new_f_name}_part_{i}.pt'
+        part = {
+            'ebird_code': ebird_code,
+            'filename': part_f_name,
+            'n_frames': mel_spec.size(1),
+            'part_duration': mel_spec.size(1) * hop_length / target_sampling_rate,
+            'stats': compute_mel_stats(mel_spec),
+        }
+        if storage == 'shards':
+            part.update(append_to_shard(shards_dir, shard_name, mel_spec, mel_dtype))
+        else:
+            Path(new_dir).mkdir(parents=True, exist_ok=True)
+            save_mel_spec(mel_spec, os.path.join(new_dir, part_f_name), mel_dtype)
+
+        if save_waveforms:
+            # Samples of the frames of the part, the last part gets the rest of the recording
+            end_frame = start_frame + mel_spec.size(1)
+            end_sample = None if i == len(mel_specs) - 1 else end_frame * hop_length
+            waveform_part = waveform[start_frame * hop_length:end_sample]
+            waveform_dir = os.path.join(output_dir, WAVEFORMS_DIR, ebird_code)
+            Path(waveform_dir).mkdir(parents=True, exist_ok=True)
+            save_waveform_part(
+                waveform_part,
+                os.path.join(waveform_dir, os.path.splitext(part_f_name)[0] + '.npy')
+            )
+            part['n_samples'] = waveform_part.size(0)
+        start_frame += mel_spec.size(1)
+        parts.append(part)
+
+    return parts
+
+
+def remove_stale_parts(output_dir, old_entry, parts):
+    '''
+    Remove .pt and waveform files of the previous run that were not overwritten by
+    the new parts.
+    '''
+    if old_entry is None:
+        return
+    new_f_paths = set(
+        os.path.join(output_dir, x['ebird_code'], x['filename'])
+        for x in parts if 'shard' not in x
+    )
+    new_waveform_f_paths = set(
+        os.path.join(output_dir, WAVEFORMS_DIR, x['ebird_code'], x['filename'])
+        for x in parts if 'n_samples' in x
+    )
+    for part in old_entry['parts']:
+        f_path = os.path.join(output_dir, part['ebird_code'], part['filename'])
+        if 'shard' not in part and f_path not in new_f_paths and os.path.exists(f_path):
+            os.remove(f_path)
+        waveform_f_path = os.path.join(
+            output_dir, WAVEFORMS_DIR, part['ebird_code'], part['filename']
+        )
+        if 'n_samples' in part and waveform_f_path not in new_waveform_f_paths:
+            waveform_f_path = os.path.splitext(waveform_f_path)[0] + '.npy'
+            if os.path.exists(waveform_f_path):
+                os.remove(waveform_f_path)
+
+
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        i, n = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise click.BadParameter('Expected i/n, e.g. 0/4')
+    if not 0 <= i < n:
+        raise click.BadParameter('Expected 0 <= i < n')
+    return i, n
+
+
+def build_train_df(train_df, manifest):
+    '''
+    One row per part: original train.csv row with the part filename, group_id of the original
+    recording, n_frames and part_duration of the part, and n_samples if waveforms were saved.
+    '''
+    parts_df = pd.DataFrame([
+        {
+            'ebird_code': part['ebird_code'],
+            'source_filename': os.path.splitext(os.path.basename(entry['source']))[0],
+            'part_filename': part['filename'],
+            'part_index': i,
+            'n_frames': part['n_frames'],
+            'part_duration': part['part_duration'],
+            'n_samples': part.get('n_samples'),
+        }
+        for entry in manifest.values() for i, part in enumerate(entry['parts'])
+    ], columns=PART_COLUMNS)
+    # Also true for no parts, so an empty run gets an empty train.csv without n_samples
+    if parts_df['n_samples'].isna().any() or parts_df.empty:
+        parts_df = parts_df.drop(columns=['n_samples'])
+
+    train_df = train_df.copy()
+    train_df['group_id'] = range(len(train_df))
+    train_df['source_filename'] = train_df['filename'].str.rsplit('.', n=1).str[0]
+
+    new_train_df = train_df.merge(parts_df, on=['ebird_code', 'source_filename'])
+    new_train_df = new_train_df.sort_values(['group_id', 'part_index'])
+    new_train_df['filename'] = new_train_df['part_filename']
+    new_train_df = new_train_df.drop(columns=['source_filename', 'part_filename', 'part_index'])
+    return new_train_df.reset_index(drop=True)
+
+
+def finalize_prepared_data(train_csv_path, output_dir, manifest, n_folds=5, seed=123):
+    '''
+    Write shards index, normalization statistics and train.csv for all processed parts.
+    Statistics are also written for the training folds of every validation fold of n_folds
+    folds with seed (the folds train_model.py uses).
+    '''
+    # Index is rebuilt from the manifest, data of re-processed parts is left unused in shards
+    index = [
+        {k: v for k, v in part.items() if k != 'stats'}
+        for entry in manifest.values() for part in entry['parts'] if 'shard' in part
+    ]
+    if index:
+        write_index(os.path.join(output_dir, SHARDS_DIR), index)
+
+    new_train_df = build_train_df(pd.read_csv(train_csv_path), manifest)
+    new_train_path = os.path.join(output_dir, 'train.csv')
+    new_train_df.to_csv(new_train_path)
+
+    # Manifests written before the stats sidecar kept the statistics in the parts
+    part_stats = read_part_stats(output_dir)
+    for entry in manifest.values():
+        for part in entry['parts']:
+            if 'stats' in part:
+                part_stats.setdefault(mel_key(part['ebird_code'], part['filename']), part['stats'])
+    stats = [
+        part_stats.get(mel_key(ebird_code, filename))
+        for ebird_code, filename in zip(new_train_df['ebird_code'], new_train_df['filename'])
+    ]
+    # Spectrogram parameters are recorded only if all recordings were processed with the same
+    params = set(
+        tuple(entry['params'].get(x) for x in MEL_PARAM_NAMES) for entry in manifest.values()
+    )
+    mel_params = dict(zip(MEL_PARAM_NAMES, params.pop())) if len(params) == 1 else None
+
+    write_mel_stats(
+        os.path.join(output_dir, MEL_STATS_FILENAME),
+        dict(merge_mel_stats(x for x in stats if x is not None), mel_params=mel_params)
+    )
+    if len(new_train_df) > 0:
+        folds = load_folds(new_train_path, new_train_df, n_folds, seed)
+        for fold in range(n_folds):
+            fold_stats = merge_mel_stats(
+                x for x, y in zip(stats, folds) if x is not None and y != fold
+            )
+            write_mel_stats(
+                os.path.join(output_dir, fold_stats_filename(fold, n_folds)),
+                dict(fold_stats, mel_params=mel_params)
+            )
 
 
 @click.command()
@@ -93,34 +300,112 @@ def process_file(f_path, output_dir, target_sampling_rate, max_duration,
 @click.option('--n_mels', default=128)
 @click.option('--hop_length', default=512)
 @click.option('--n_jobs', default=28)
+@click.option('--storage', type=click.Choice(['pt', 'shards']), default='pt')
+@click.option('--mel_dtype', type=click.Choice(MEL_DTYPES), default='float32',
+              help='float16 and uint8 store quantized log mel spectrograms')
+@click.option('--hash_sources', is_flag=True, default=False,
+              help='Detect changed recordings by sha1 of the content instead of size and mtime')
+@click.option('--force', is_flag=True, default=False, help='Reprocess all recordings')
+@click.option('--chunk_size', default=512, help='Recordings processed between manifest updates')
+@click.option('--memory_budget_gb', default=64.,
+              help='Max estimated memory of recordings processed at the same time')
+@click.option('--memory_factor', default=80.,
+              help='Estimated memory needed to process a recording per byte of mp3')
+@click.option('--max_retries', default=2)
+@click.option('--n_threads', default=1, help='Torch threads of every worker')
+@click.option('--shard', default=None, callback=parse_shard,
+              help='Process only shard i of n of the recordings, e.g. 0/4')
+@click.option('--save_waveforms', is_flag=True, default=False,
+              help='Save resampled waveforms of the parts as int16 for waveform training')
+@click.option('--n_folds', default=5, help='Folds of the per fold normalization statistics')
+@click.option('--seed', default=123, help='Seed of the folds')
 def main(train_csv_path, input_dir, output_dir, target_sampling_rate,
-         max_duration, n_fft, n_mels, hop_length, n_jobs):
-    f_paths = Path(input_dir).rglob('*.mp3')
-    Parallel(n_jobs=n_jobs, verbose=10)(
-        delayed(process_file)(
-            f_path, output_dir, target_sampling_rate,
-            max_duration, n_fft, n_mels, hop_length
-        )
-        for f_path in f_paths
+         max_duration, n_fft, n_mels, hop_length, n_jobs, storage, mel_dtype,
+         hash_sources, force, chunk_size, memory_budget_gb, memory_factor, max_retries, n_threads,
+         shard, save_waveforms, n_folds, seed):
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    manifest_path = os.path.join(output_dir, manifest_filename(shard))
+    part_stats_path = os.path.join(output_dir, part_stats_filename(shard))
+    manifest = read_manifests(output_dir)
+    params = {
+        'target_sampling_rate': target_sampling_rate,
+        'max_duration': max_duration,
+        'n_fft': n_fft,
+        'n_mels': n_mels,
+        'hop_length': hop_length,
+        'storage': storage,
+        'mel_dtype': mel_dtype,
+    }
+    if save_waveforms:
+        # Only added when set, so existing manifests stay up to date without waveforms
+        params['save_waveforms'] = True
+
+    jobs = []
+    f_paths = sorted(Path(input_dir).rglob('*.mp3'))
+    for f_path in f_paths:
+        source = f_path.relative_to(input_dir).as_posix()
+        if shard is not None and source_shard(source, shard[1]) != shard[0]:
+            continue
+        fingerprint = file_fingerprint(f_path, hash_sources)
+        if force or not is_up_to_date(manifest.get(source), fingerprint, params):
+            jobs.append((f_path, source, fingerprint))
+    print(f'To process: {len(jobs)} of {len(f_paths)}')
+
+    scheduler = MemoryBoundedScheduler(
+        n_jobs, memory_budget_gb * 2 ** 30, max_retries, n_threads=n_threads
     )
-    train_df = pd.read_csv(train_csv_path)
-    new_train_df = []
-    for group_id, item in enumerate(train_df.to_dict(orient='records')):
-
-        filename = os.path.splitext(item['filename'])[0]
-        path = os.path.join(
-            output_dir,
-            item['ebird_code']
+    fingerprints = {source: fingerprint for _, source, fingerprint in jobs}
+    scheduler_jobs = [
+        (
+            source,
+            (
+                f_path, output_dir, target_sampling_rate,
+                max_duration, n_fft, n_mels, hop_length, storage, mel_dtype,
+                0 if shard is None else shard[0], save_waveforms
+            ),
+            os.path.getsize(f_path) * memory_factor
+        )
+        for f_path, source, _ in jobs
+    ]
+    entries = []
+    stats_records = []
+    for source, parts in scheduler.run(process_file, scheduler_jobs):
+        remove_stale_parts(output_dir, manifest.get(source), parts)
+        processed_at = time.time()
+        # Statistics go to the sidecar, the manifest is read on every run
+        stats_records.extend(
+            {
+                'key': mel_key(part['ebird_code'], part['filename']),
+                'processed_at': processed_at,
+                'stats': part.pop('stats'),
+            }
+            for part in parts
         )
-        f_paths = Path(path).glob(f'{filename}_part_*.pt')
-        for f_path in f_paths:
-            new_filename = os.path.basename(f_path)
-            new_item = item.copy()
-            new_item['filename'] = new_filename
-            new_item['group_id'] = group_id
-            new_train_df.append(new_item)
-    new_train_df = pd.DataFrame(new_train_df)
-    new_train_df.to_csv(os.path.join(output_dir, 'train.csv'))
+        entry = {
+            'source': source,
+            'fingerprint': fingerprints[source],
+            'params': params,
+            'parts': parts,
+            'processed_at': processed_at,
+        }
+        manifest[source] = entry
+        entries.append(entry)
+        if len(entries) >= chunk_size:
+            # Statistics first, so the manifest never lists parts without them
+            append_part_stats(part_stats_path, stats_records)
+            append_manifest(manifest_path, entries)
+            entries = []
+            stats_records = []
+    append_part_stats(part_stats_path, stats_records)
+    append_manifest(manifest_path, entries)
+
+    scheduler.write_failure_report(os.path.join(output_dir, failures_filename(shard)))
+    print(f'Failed: {len(scheduler.failures)}, see {failures_filename(shard)}')
+
+    if shard is None:
+        finalize_prepared_data(train_csv_path, output_dir, manifest, n_folds, seed)
+    else:
+        print('Run merge_prepared_data.py after all shards are finished')
 
 
 if __name__ == '__main__':
@@ -1,27 +1,29 @@
+'''
+Resample audio files to a single sampling rate.
+
+Files are grouped by their source sampling rate and resampled in batches: each job loads
+several files of the same rate, pads them to the same length and resamples them with one
+call of a Resample transform cached in the worker process. Batches are scheduled largest
+first with a memory budget (see src/data/scheduler.py), files that failed are listed in
+<output_dir>/failures.csv.
+'''
 import os
+import math
+import time
 import click
 import torchaudio as toa
 import torch as t
+from collections import defaultdict
 from pathlib import Path
-from joblib import Parallel, delayed
-
+from src.data.scheduler import MemoryBoundedScheduler
+from src.data.transform_cache import get_resample_transform
 
-def process_file(f_path, resample_rate, output_dir):
-    try:
-        waveform, old_sampling_rate = toa.load(f_path)
-    except RuntimeError:
-        print(f'Failed to load: {f_path}')
-        return
 
-    waveform = waveform[0]
+def get_sampling_rate(f_path):
+    return toa.info(str(f_path)).sample_rate
 
-    with t.no_grad():
-        resample_transform = toa.transforms.Resample(
-            old_sampling_rate,
-            resample_rate
-        )
-        waveform = resample_transform(waveform)
 
+def save_waveform(f_path, waveform, resample_rate, output_dir):
     f_name = os.path.basename(f_path)
     new_f_name = os.path.splitext(f_name)[0] + '.mp3'
     ebird_code = os.path.basename(os.path.dirname(f_path))
@@ -32,17 +34,108 @@ def process_file(f_path, resample_rate, output_dir):
     toa.save(new_f_path, waveform, resample_rate)
 
 
+def process_batch(f_paths, old_sampling_rate, resample_rate, output_dir):
+    '''Resample files with the same sampling rate as one padded batch.'''
+    start_time = time.perf_counter()
+
+    waveforms = []
+    loaded_f_paths = []
+    failures = []
+    for f_path in f_paths:
+        try:
+            waveform, _ = toa.load(f_path)
+        except RuntimeError as e:
+            failures.append({'key': str(f_path), 'error': f'Failed to load: {e}', 'attempts': 1})
+            continue
+        waveforms.append(waveform[0])
+        loaded_f_paths.append(f_path)
+
+    if not waveforms:
+        return old_sampling_rate, 0, time.perf_counter() - start_time, failures
+
+    lengths = [x.size(0) for x in waveforms]
+    batch = t.zeros(len(waveforms), max(lengths))
+    for i, waveform in enumerate(waveforms):
+        batch[i, :lengths[i]] = waveform
+
+    if old_sampling_rate != resample_rate:
+        with t.no_grad():
+            batch = get_resample_transform(old_sampling_rate, resample_rate)(batch)
+
+    for i, f_path in enumerate(loaded_f_paths):
+        new_length = math.ceil(lengths[i] * resample_rate / old_sampling_rate)
+        save_waveform(f_path, batch[i:i + 1, :new_length], resample_rate, output_dir)
+
+    return old_sampling_rate, len(loaded_f_paths), time.perf_counter() - start_time, failures
+
+
 @click.command()
 @click.argument('input_dir')
 @click.argument('output_dir')
 @click.option('--resample_rate', default=44100)
 @click.option('--n_jobs', default=30)
-def main(input_dir, output_dir, resample_rate, n_jobs):
+@click.option('--batch_size', default=8, help='Files of the same sampling rate per batch')
+@click.option('--memory_budget_gb', default=64.,
+              help='Max estimated memory of batches processed at the same time')
+@click.option('--memory_factor', default=50.,
+              help='Estimated memory needed to resample a file per byte of mp3')
+@click.option('--max_retries', default=2)
+@click.option('--n_threads', default=1, help='Torch threads of every worker')
+def main(input_dir, output_dir, resample_rate, n_jobs, batch_size,
+         memory_budget_gb, memory_factor, max_retries, n_threads):
     f_paths = Path(input_dir).rglob('*.mp3')
-    Parallel(n_jobs=n_jobs, verbose=10)(
-        delayed(process_file)(f_path, resample_rate, output_dir)
-        for f_path in f_paths
+
+    failures = []
+    rate_groups = defaultdict(list)
+    for f_path in f_paths:
+        try:
+            rate_groups[get_sampling_rate(f_path)].append(f_path)
+        except RuntimeError as e:
+            failures.append({'key': str(f_path), 'error': f'Failed to load: {e}', 'attempts': 1})
+
+    # Files of similar size are batched together to reduce padding
+    jobs = []
+    for old_sampling_rate, group_f_paths in rate_groups.items():
+        group_f_paths = sorted(group_f_paths, key=lambda x: os.path.getsize(x))
+        for i in range(0, len(group_f_paths), batch_size):
+            jobs.append((group_f_paths[i:i + batch_size], old_sampling_rate))
+
+    scheduler = MemoryBoundedScheduler(
+        n_jobs, memory_budget_gb * 2 ** 30, max_retries, n_threads=n_threads
     )
+    scheduler_jobs = [
+        (
+            i,
+            (batch_f_paths, old_sampling_rate, resample_rate, output_dir),
+            sum(os.path.getsize(x) for x in batch_f_paths) * memory_factor
+        )
+        for i, (batch_f_paths, old_sampling_rate) in enumerate(jobs)
+    ]
+
+    start_time = time.perf_counter()
+    n_files = defaultdict(int)
+    worker_seconds = defaultdict(float)
+    for _, (old_sampling_rate, n, seconds, batch_failures) in scheduler.run(
+        process_batch, scheduler_jobs
+    ):
+        n_files[old_sampling_rate] += n
+        worker_seconds[old_sampling_rate] += seconds
+        failures.extend(batch_failures)
+    elapsed = time.perf_counter() - start_time
+
+    # Batches that failed as a whole are reported with their files
+    for failure in scheduler.failures:
+        batch_f_paths = jobs[int(failure['key'])][0]
+        failures.extend(dict(failure, key=str(x)) for x in batch_f_paths)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    scheduler.write_failure_report(os.path.join(output_dir, 'failures.csv'), failures)
+
+    print('Sampling rate | files | files/sec per worker')
+    for old_sampling_rate in sorted(n_files):
+        files_per_sec = n_files[old_sampling_rate] / max(worker_seconds[old_sampling_rate], 1e-9)
+        print(f'{old_sampling_rate:>13} | {n_files[old_sampling_rate]:>5} | {files_per_sec:.2f}')
+    print(f'Total: {sum(n_files.values())} files in {elapsed:.1f} sec, '
+          f'{sum(n_files.values()) / elapsed:.2f} files/sec, failed: {len(failures)}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+'''
+Batch samplers for variable length mel spectrograms.
+
+Collate pads every spectrogram of a batch to the longest one rounded up to a multiple of
+n_frames and the model runs on every segment including padding. Batching items of similar
+length and limiting the number of padded segments per batch instead of the number of items
+keeps both the padding and the cost of a batch roughly constant.
+'''
+import numpy as np
+
+
+def segment_counts(n_frames, segment_frames):
+    return np.maximum(np.ceil(np.asarray(n_frames) / segment_frames), 1).astype(np.int64)
+
+
+def padding_fraction(batches, n_frames, segment_frames):
+    '''Part of segment frames of the batches that are padding.'''
+    n_frames = np.asarray(n_frames)
+    segments = segment_counts(n_frames, segment_frames)
+    real = 0
+    padded = 0
+    for batch in batches:
+        real += n_frames[batch].sum()
+        padded += len(batch) * segments[batch].max() * segment_frames
+    return 1 - real / max(padded, 1)
+
+
+class SegmentBudgetBatchSampler:
+    '''
+    Batches of items with similar number of segments.
+    n_frames: number of frames of each item of the dataset.
+    segment_frames: n_frames of Collate.
+    max_segments: max of batch size * segments of the longest item in a batch, an item longer
+    than the budget gets a batch of its own.
+    Items are sorted by number of segments with random order among equal ones and batch order
+    is shuffled every epoch.
+    '''
+    def __init__(self, n_frames, segment_frames, max_segments, max_batch_size=None,
+                 shuffle=True):
+        self.n_frames = np.asarray(n_frames, dtype=np.int64)
+        self.segment_frames = segment_frames
+        self.segments = segment_counts(self.n_frames, segment_frames)
+        self.max_segments = max_segments
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        # Batch sizes depend only on sorted segment counts, so they are the same every epoch
+        self.n_batches = len(self.make_batches(np.argsort(self.segments, kind='stable')))
+
+    def make_batches(self, order):
+        batches = []
+        batch = []
+        for i in order:
+            batch_segments = self.segments[i] * (len(batch) + 1)
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (batch_segments > self.max_segments or full):
+                batches.append(batch)
+                batch = []
+            batch.append(int(i))
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.lexsort((np.random.permutation(len(self.segments)), self.segments))
+        else:
+            order = np.argsort(self.segments, kind='stable')
+        batches = self.make_batches(order)
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        return self.n_batches
+
+    def padding_report(self, batch_size):
+        '''Padding fraction of random batches of batch_size items and of this sampler.'''
+        order = np.random.permutation(len(self.n_frames))
+        random_batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+        batches = list(self)
+        return {
+            'random_padding': padding_fraction(
+                random_batches, self.n_frames, self.segment_frames
+            ),
+            'bucketed_padding': padding_fraction(batches, self.n_frames, self.segment_frames),
+            'random_batches': len(random_batches),
+            'bucketed_batches': len(batches),
+            'mean_batch_size': len(self.n_frames) / max(len(batches), 1),
+        }
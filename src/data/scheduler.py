@@ -0,0 +1,141 @@
+'''
+Scheduler for preprocessing jobs.
+
+Jobs are started largest first and the estimated memory of running jobs is kept under a
+budget, so long recordings neither become stragglers at the end of a run nor land on the
+workers all at once. Failed jobs are retried and recorded in a failure report.
+Workers are limited to n_threads intra-op threads each, so n_jobs workers running torch
+do not oversubscribe the CPU.
+'''
+import os
+import time
+import traceback
+import pandas as pd
+import torch as t
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+class PermanentError(Exception):
+    '''Raised by a job for failures that are not worth retrying, e.g. a corrupted file.'''
+
+
+def limit_threads(n_threads):
+    '''Process pool initializer.'''
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(n_threads)
+    t.set_num_threads(n_threads)
+
+
+class MemoryBoundedScheduler:
+    '''
+    Run jobs in a process pool.
+    n_jobs: max number of running jobs.
+    memory_budget: max total estimated memory of running jobs in bytes. A job estimated
+    to need more than the whole budget is run alone.
+    max_retries: how many times a failed job is restarted. When a worker dies, an attempt
+    is counted only for a job that was running alone, other jobs are retried alone first.
+    n_threads: torch (OpenMP/MKL) threads of every worker.
+    '''
+    def __init__(self, n_jobs, memory_budget, max_retries=2, log_every=100, n_threads=1):
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+        self.memory_budget = memory_budget
+        self.max_retries = max_retries
+        self.log_every = log_every
+        self.failures = []
+
+    def run(self, fn, jobs):
+        '''
+        jobs: list of (key, args, estimated_memory).
+        Yields (key, fn(*args)) in order of completion.
+        '''
+        pending = deque(sorted(jobs, key=lambda x: x[2], reverse=True))
+        n_total = len(pending)
+        attempts = {}
+        running = {}
+        in_flight = 0
+        n_finished = 0
+        start_time = time.perf_counter()
+
+        executor = self.executor()
+        try:
+            while pending or running:
+                # Largest pending job waits for memory instead of being overtaken by smaller ones
+                while pending and len(running) < self.n_jobs:
+                    key, args, memory = pending[0]
+                    if running and in_flight + memory > self.memory_budget:
+                        break
+                    pending.popleft()
+                    running[executor.submit(fn, *args)] = (key, args, memory)
+                    in_flight += memory
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                if any(isinstance(x.exception(), BrokenProcessPool) for x in done):
+                    # A broken pool fails all its jobs, they finish right away
+                    done, _ = wait(running)
+                broken = []
+                for future in done:
+                    key, args, memory = running.pop(future)
+                    in_flight -= memory
+                    try:
+                        result = future.result()
+                    except PermanentError as e:
+                        self.add_failure(key, e, attempts.get(key, 0) + 1)
+                    except BrokenProcessPool as e:
+                        broken.append((key, args, memory))
+                        broken_error = e
+                    except Exception as e:
+                        self.retry(pending, attempts, (key, args, memory), e)
+                    else:
+                        yield key, result
+                    n_finished += 1
+                    if n_finished % self.log_every == 0:
+                        elapsed = time.perf_counter() - start_time
+                        print(f'[{n_finished}/{n_total}] elapsed: {elapsed:.0f} sec, '
+                              f'failed: {len(self.failures)}')
+
+                if broken:
+                    # Worker was killed, most likely out of memory. Which job it ran is
+                    # unknown when several were running, so they are all retried alone
+                    # without counting an attempt. A job that kills the pool alone is counted.
+                    executor.shutdown(wait=False)
+                    executor = self.executor()
+                    for key, args, memory in broken:
+                        job = (key, args, max(memory, self.memory_budget))
+                        if len(broken) == 1:
+                            self.retry(pending, attempts, job, broken_error)
+                        else:
+                            pending.appendleft(job)
+        finally:
+            executor.shutdown(wait=True)
+
+    def executor(self):
+        return ProcessPoolExecutor(
+            self.n_jobs, initializer=limit_threads, initargs=(self.n_threads,)
+        )
+
+    def retry(self, pending, attempts, job, error):
+        key = job[0]
+        attempts[key] = attempts.get(key, 0) + 1
+        if attempts[key] <= self.max_retries:
+            pending.appendleft(job)
+        else:
+            self.add_failure(key, error, attempts[key])
+
+    def add_failure(self, key, error, attempts):
+        self.failures.append({
+            'key': str(key),
+            'error': ''.join(traceback.format_exception_only(type(error), error)).strip(),
+            'attempts': attempts,
+        })
+
+    def write_failure_report(self, path, failures=None):
+        '''failures: written instead of the failures of the scheduler if given.'''
+        if failures is None:
+            failures = self.failures
+        pd.DataFrame(failures, columns=['key', 'error', 'attempts']).to_csv(path, index=False)
@@ -0,0 +1,132 @@
+'''
+Chunked decoding, resampling and mel transformation of long recordings.
+
+Each stage is a generator over chunks (channels x samples or channels x n_mels x frames)
+and carries the overlap it needs between chunks, so the concatenated output matches
+the result of transforming the whole recording at once while only a few chunks are held
+in memory.
+'''
+import math
+import torch as t
+import torchaudio as toa
+from src.data.transform_cache import get_mel_transform, get_resample_transform
+
+
+# Input samples kept on each side of a block while resampling, much wider than the
+# interpolation kernel of toa.transforms.Resample.
+RESAMPLE_CONTEXT_N = 256
+
+
+def open_audio_stream(filepath, chunk_duration=10):
+    '''Returns original sampling rate and generator of channels x samples chunks.'''
+    streamer = toa.io.StreamReader(filepath)
+    sampling_rate = int(streamer.get_src_stream_info(streamer.default_audio_stream).sample_rate)
+    streamer.add_basic_audio_stream(frames_per_chunk=int(chunk_duration * sampling_rate))
+
+    def iter_chunks():
+        for (chunk,) in streamer.stream():
+            yield chunk.t()
+
+    return sampling_rate, iter_chunks()
+
+
+def iter_resampled_chunks(chunks, old_sampling_rate, new_sampling_rate):
+    '''
+    Resample a stream of chunks.
+    Blocks are resampled with RESAMPLE_CONTEXT_N input samples of context on both sides and
+    block boundaries are multiples of old_sampling_rate / gcd, so output samples are aligned.
+    '''
+    if old_sampling_rate == new_sampling_rate:
+        yield from chunks
+        return
+
+    gcd = math.gcd(old_sampling_rate, new_sampling_rate)
+    old_n = old_sampling_rate // gcd
+    new_n = new_sampling_rate // gcd
+    context_n = math.ceil(RESAMPLE_CONTEXT_N / old_n) * old_n
+    resample_transform = get_resample_transform(old_sampling_rate, new_sampling_rate)
+
+    buffer = None
+    left_n = 0  # Samples of left context at the beginning of the buffer
+    with t.no_grad():
+        for chunk in chunks:
+            buffer = chunk if buffer is None else t.cat((buffer, chunk), dim=-1)
+            block_n = (buffer.size(-1) - left_n - context_n) // old_n * old_n
+            if block_n <= 0:
+                continue
+            resampled = resample_transform(buffer[..., :left_n + block_n + context_n])
+            yield resampled[..., left_n // old_n * new_n:(left_n + block_n) // old_n * new_n]
+
+            new_left_n = min(context_n, left_n + block_n)
+            buffer = buffer[..., left_n + block_n - new_left_n:]
+            left_n = new_left_n
+
+        if buffer is not None and buffer.size(-1) > left_n:
+            resampled = resample_transform(buffer)
+            yield resampled[..., left_n // old_n * new_n:]
+
+
+def iter_mel_chunks(chunks, sampling_rate, n_fft=2048, n_mels=128, hop_length=512):
+    '''
+    Mel transform a stream of waveform chunks.
+    Equivalent to MelSpectrogram(center=True) of the whole waveform: the waveform is
+    reflect padded at both ends and the frames of the next chunk start from the
+    samples left over from the previous one.
+    '''
+    mel_transform = get_mel_transform(sampling_rate, n_fft, n_mels, hop_length, center=False)
+    pad = n_fft // 2
+
+    buffer = None
+    with t.no_grad():
+        for chunk in chunks:
+            if buffer is None:
+                buffer = t.cat((t.flip(chunk[..., 1:pad + 1], [-1]), chunk), dim=-1)
+            else:
+                buffer = t.cat((buffer, chunk), dim=-1)
+            n_frames = (buffer.size(-1) - n_fft) // hop_length + 1
+            if n_frames <= 0:
+                continue
+            yield mel_transform(buffer[..., :(n_frames - 1) * hop_length + n_fft])
+            buffer = buffer[..., n_frames * hop_length:]
+
+        if buffer is None:
+            return
+        buffer = t.cat((buffer, t.flip(buffer[..., -pad - 1:-1], [-1])), dim=-1)
+        n_frames = (buffer.size(-1) - n_fft) // hop_length + 1
+        if n_frames > 0:
+            yield mel_transform(buffer[..., :(n_frames - 1) * hop_length + n_fft])
+
+
+def iter_mel_windows(mel_chunks, frame_ranges):
+    '''
+    Cut windows from a stream of mel chunks.
+    frame_ranges: list of (start, end) frame indices sorted by start, end=None means
+    until the end of the recording.
+    Only frames of the current window are kept in memory.
+    '''
+    buffer = []
+    buffer_start = 0
+    buffer_end = 0
+    exhausted = False
+
+    for start, end in frame_ranges:
+        while not exhausted and (end is None or buffer_end < end):
+            try:
+                mel_chunk = next(mel_chunks)
+            except StopIteration:
+                exhausted = True
+                break
+            buffer.append(mel_chunk)
+            buffer_end += mel_chunk.size(-1)
+
+        # Drop chunks that end before the window starts
+        while len(buffer) > 1 and buffer_start + buffer[0].size(-1) <= start:
+            buffer_start += buffer[0].size(-1)
+            buffer.pop(0)
+
+        if buffer:
+            mel_spec = t.cat(buffer, dim=-1)
+            window_end = mel_spec.size(-1) if end is None else end - buffer_start
+            yield mel_spec[..., start - buffer_start:window_end]
+        else:
+            yield None
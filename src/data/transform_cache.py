@@ -0,0 +1,34 @@
+'''
+Per-process cache of torchaudio transforms.
+
+Resample computes its sinc interpolation kernel and MelSpectrogram its window and mel
+filterbank on construction, so transforms are created once per process and reused.
+'''
+import torchaudio as toa
+
+
+RESAMPLE_TRANSFORMS = {}
+MEL_TRANSFORMS = {}
+
+
+def get_resample_transform(old_sampling_rate, new_sampling_rate):
+    key = (old_sampling_rate, new_sampling_rate)
+    if key not in RESAMPLE_TRANSFORMS:
+        RESAMPLE_TRANSFORMS[key] = toa.transforms.Resample(
+            old_sampling_rate,
+            new_sampling_rate
+        )
+    return RESAMPLE_TRANSFORMS[key]
+
+
+def get_mel_transform(sampling_rate, n_fft, n_mels, hop_length, center=True):
+    key = (sampling_rate, n_fft, n_mels, hop_length, center)
+    if key not in MEL_TRANSFORMS:
+        MEL_TRANSFORMS[key] = toa.transforms.MelSpectrogram(
+            sample_rate=sampling_rate,
+            n_fft=n_fft,
+            n_mels=n_mels,
+            hop_length=hop_length,
+            center=center
+        )
+    return MEL_TRANSFORMS[key]
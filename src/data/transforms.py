@@ -1,6 +1,6 @@
 import torch as t
 import numpy as np
-import torch.nn as nn
+import torch.nn.functional as F
 
 
 class RandomCrop:
@@ -12,8 +12,8 @@ class RandomCrop:
         duration = spec.size(1)
         if duration > self.n_frames:
             max_i = duration - self.n_frames
-            i = np.random.randint(0, max_i)
-            spec = spec[i, i + self.n_frames]
+            i = np.random.randint(0, max_i + 1)
+            spec = spec[:, i:i + self.n_frames]
 
         return spec
 
@@ -26,12 +26,11 @@ class RandomTimeResize:
 
     def __call__(self, spec):
         scale_factor = 1 + (np.random.random_sample() - 0.5) * self.resize_range
-        new_spec = nn.Upsample(
+        new_spec = F.interpolate(
+            spec.unsqueeze(0).unsqueeze(0),
             scale_factor=(1, scale_factor),
             mode=self.resize_mode,
             align_corners=False
-        )(
-            spec.unsqueeze(0).unsqueeze(0)
         ).squeeze(0).squeeze(0)
         return new_spec
 
@@ -42,12 +41,9 @@ class RandomTimeShift:
         self.shift_range = shift_range
 
     def __call__(self, spec):
-        new_spec = t.zeros_like(spec)
         duration = spec.size(1)
         shift = int(np.random.random_sample() * duration * self.shift_range) + 1
-        new_spec[:, :shift] = spec[:, -shift:]
-        new_spec[:, shift:] = spec[:, :-shift]
-        return new_spec
+        return t.roll(spec, shift, dims=1)
 
 
 class WaveformRandomTimeResize:
@@ -58,12 +54,11 @@ class WaveformRandomTimeResize:
 
     def __call__(self, waveform):
         scale_factor = 1 + (np.random.random_sample() - 0.5) * self.resize_range
-        waveform = nn.Upsample(
+        waveform = F.interpolate(
+            waveform.unsqueeze(0).unsqueeze(0),
             scale_factor=(scale_factor,),
             mode=self.resize_mode,
             align_corners=False
-        )(
-            waveform.unsqueeze(0).unsqueeze(0)
         ).squeeze(0).squeeze(0)
         return waveform
 
@@ -74,27 +69,29 @@ class WaveformRandomTimeShift:
         self.shift_range = shift_range
 
     def __call__(self, waveform):
-        new_waveform = t.zeros_like(waveform)
         duration = waveform.size(0)
         shift = int(np.random.random_sample() * duration * self.shift_range) + 1
-        new_waveform[:shift] = waveform[-shift:]
-        new_waveform[shift:] = waveform[:-shift]
-
-        return new_waveform
+        return t.roll(waveform, shift, dims=0)
 
 
 class SpecMixup:
     '''
     Mixup spectrogram of a sample with a spectrogram of a random sample from the mixup dataset.
     The smallest spectrogram is repeated until both spectograms are of the same size.
+    partner_sampler: picks the mixup sample by primary ebird code of the sample
+    (e.g. CooccurrencePartnerSampler), uniformly random by default.
     '''
-    def __init__(self, mixup_sample_dataset, alpha=0.5, mixup_labels=True):
+    def __init__(self, mixup_sample_dataset, alpha=0.5, mixup_labels=True, partner_sampler=None):
         self.mixup_sample_dataset = mixup_sample_dataset
         self.alpha = alpha
         self.mixup_labels = mixup_labels
+        self.partner_sampler = partner_sampler
 
     def __call__(self, sample):
-        i = np.random.randint(0, len(self.mixup_sample_dataset))
+        if self.partner_sampler is not None:
+            i = self.partner_sampler.sample(sample['primary_ebird_code'])
+        else:
+            i = np.random.randint(0, len(self.mixup_sample_dataset))
         mixup_sample = self.mixup_sample_dataset[i]
 
         sample_spec = sample['mel_spec']
@@ -125,6 +122,50 @@ class SpecMixup:
         return sample
 
 
+class BatchSpecMixup:
+    '''
+    Mixup spectrograms of a batch with spectrograms of other samples from the same batch.
+    Each sample is mixed with probability p, partners are taken from a random permutation.
+    The shortest spectrogram of a pair is repeated until both are of the same size.
+    Works on padded mel spectrograms (batch x n_mels x frames) before normalization
+    or on padded waveforms (batch x 1 x samples).
+    '''
+    def __init__(self, p=0.5, alpha=0.5, mixup_labels=True):
+        self.p = p
+        self.alpha = alpha
+        self.mixup_labels = mixup_labels
+
+    def __call__(self, mel_specs, lengths, encoded_ebird_codes):
+        batch_size, _, max_length = mel_specs.shape
+
+        # One cycle over a random order, so no sample is its own partner
+        order = t.randperm(batch_size)
+        partners = t.empty_like(order)
+        partners[order] = order.roll(-1)
+        mixed = t.rand(batch_size) < self.p
+        if not mixed.any():
+            return mel_specs, lengths, encoded_ebird_codes
+
+        frames = t.arange(max_length)
+        tile_index = frames.unsqueeze(0) % lengths.clamp(min=1).unsqueeze(1)
+        tiled_specs = mel_specs.gather(2, tile_index.unsqueeze(1).expand_as(mel_specs))
+
+        mixed_lengths = t.max(lengths, lengths[partners])
+        mixed_specs = tiled_specs * (1 - self.alpha) + tiled_specs[partners] * self.alpha
+        mixed_specs *= (frames.unsqueeze(0) < mixed_lengths.unsqueeze(1)).unsqueeze(1)
+
+        mel_specs = t.where(mixed.view(-1, 1, 1), mixed_specs, mel_specs)
+        lengths = t.where(mixed, mixed_lengths, lengths)
+        if self.mixup_labels:
+            encoded_ebird_codes = t.where(
+                mixed.view(-1, 1),
+                t.max(encoded_ebird_codes, encoded_ebird_codes[partners]),
+                encoded_ebird_codes
+            )
+
+        return mel_specs, lengths, encoded_ebird_codes
+
+
 class SpecTransform:
     def __init__(self, transform):
         self.transform = transform
@@ -132,3 +173,121 @@ class SpecTransform:
     def __call__(self, sample):
         sample['mel_spec'] = self.transform(sample['mel_spec'])
         return sample
+
+
+class WaveformTransform:
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, sample):
+        sample['waveform'] = self.transform(sample['waveform'])
+        return sample
+
+
+def frame_mask(lengths, n_frames):
+    '''batch x n_frames mask of frames inside each spectrogram.'''
+    return t.arange(n_frames, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+
+class BatchRandomTimeShift:
+    '''
+    Batch version of RandomTimeShift.
+    Batch transforms take padded spectrograms (batch x n_mels x frames) with their lengths
+    and return both, every sample gets its own random parameters. Frames after the length
+    of a spectrogram are zero. Random parameters are created on the device of the batch.
+    '''
+    def __init__(self, shift_range=0.5, p=1.):
+        self.shift_range = shift_range
+        self.p = p
+
+    def __call__(self, mel_specs, lengths):
+        device = mel_specs.device
+        lengths = lengths.to(device)
+        n_frames = mel_specs.size(2)
+        rand = t.rand(2, len(lengths), device=device)
+        shifts = (rand[0] * lengths.float() * self.shift_range).long() + 1
+        shifts *= (rand[1] < self.p).long()
+
+        frames = t.arange(n_frames, device=device).unsqueeze(0)
+        source = (frames - shifts.unsqueeze(1)) % lengths.clamp(min=1).unsqueeze(1)
+        mel_specs = mel_specs.gather(2, source.unsqueeze(1).expand_as(mel_specs))
+        return mel_specs * frame_mask(lengths, n_frames).unsqueeze(1), lengths
+
+
+class BatchRandomTimeResize:
+    '''
+    Batch version of RandomTimeResize with bilinear resize mode: linear interpolation along
+    time with a separate scale factor for every sample.
+    '''
+    def __init__(self, resize_range=0.2, p=1.):
+        self.resize_range = resize_range
+        self.p = p
+
+    def __call__(self, mel_specs, lengths):
+        device = mel_specs.device
+        lengths = lengths.to(device)
+        rand = t.rand(2, len(lengths), device=device)
+        scale_factors = 1 + (rand[0] - 0.5) * self.resize_range
+        scale_factors[rand[1] >= self.p] = 1.
+        new_lengths = (lengths.float() * scale_factors).floor().long().clamp(min=1)
+        n_frames = int(new_lengths.max())
+
+        # Source positions as computed by F.interpolate with align_corners=False
+        frames = t.arange(n_frames, device=device).unsqueeze(0).float()
+        source = ((frames + 0.5) / scale_factors.unsqueeze(1) - 0.5).clamp(min=0)
+        last = (lengths.clamp(min=1) - 1).unsqueeze(1)
+        left = source.floor().long().min(last)
+        right = (left + 1).min(last)
+        weights = (source - left.float()).clamp(max=1).unsqueeze(1)
+
+        n_mels = mel_specs.size(1)
+        left_specs = mel_specs.gather(2, left.unsqueeze(1).expand(-1, n_mels, -1))
+        right_specs = mel_specs.gather(2, right.unsqueeze(1).expand(-1, n_mels, -1))
+        mel_specs = left_specs * (1 - weights) + right_specs * weights
+        return mel_specs * frame_mask(new_lengths, n_frames).unsqueeze(1), new_lengths
+
+
+class BatchMasking:
+    '''
+    Batch version of torchaudio TimeMasking (dim=2) and FrequencyMasking (dim=1): one mask
+    of random width up to mask_param at a random position for every sample.
+    '''
+    def __init__(self, mask_param, dim, mask_value=0., p=1.):
+        self.mask_param = mask_param
+        self.dim = dim
+        self.mask_value = mask_value
+        self.p = p
+
+    def __call__(self, mel_specs, lengths):
+        device = mel_specs.device
+        lengths = lengths.to(device)
+        batch_size = mel_specs.size(0)
+        if self.dim == 2:
+            sizes = lengths.float()
+        else:
+            sizes = t.full((batch_size,), float(mel_specs.size(self.dim)), device=device)
+
+        rand = t.rand(3, batch_size, device=device)
+        widths = rand[0] * self.mask_param
+        starts = (rand[1] * (sizes - widths)).long()
+        ends = starts + widths.long()
+        ends[rand[2] >= self.p] = 0
+
+        positions = t.arange(mel_specs.size(self.dim), device=device).unsqueeze(0)
+        mask = (positions >= starts.unsqueeze(1)) & (positions < ends.unsqueeze(1))
+        mask = mask.unsqueeze(1) if self.dim == 2 else mask.unsqueeze(2)
+        mel_specs = mel_specs.masked_fill(mask, self.mask_value)
+        if self.dim == 2:
+            return mel_specs, lengths
+        # Keep padding zero
+        return mel_specs * frame_mask(lengths, mel_specs.size(2)).unsqueeze(1), lengths
+
+
+class BatchCompose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, mel_specs, lengths):
+        for transform in self.transforms:
+            mel_specs, lengths = transform(mel_specs, lengths)
+        return mel_specs, lengths
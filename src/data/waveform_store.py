@@ -0,0 +1,37 @@
+'''
+Resampled waveforms of train parts stored as int16 .npy files.
+
+prepare_data.py --save_waveforms writes <output_dir>/waveforms/<ebird_code>/<part>.npy next
+to the mel spectrograms, with the same keys (see mel_key in src/data/mel_store.py). Files are
+memory-mapped, so a crop reads only the samples it needs.
+'''
+import os
+import numpy as np
+import torch as t
+
+
+WAVEFORMS_DIR = 'waveforms'
+INT16_SCALE = 32767.
+
+
+def save_waveform_part(waveform, f_path):
+    data = (waveform.clamp(-1., 1.) * INT16_SCALE).round().short()
+    np.save(f_path, data.numpy())
+
+
+class WaveformStore:
+    '''Same interface as mel stores, load() returns float32 waveform of given samples.'''
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.waveforms_dir = os.path.join(data_dir, WAVEFORMS_DIR)
+
+    def path(self, key):
+        return os.path.join(self.waveforms_dir, key + '.npy')
+
+    def n_frames_of(self, key):
+        return None
+
+    def load(self, key, start=0, n_samples=None):
+        data = np.load(self.path(key), mmap_mode='r')
+        end = None if n_samples is None else start + n_samples
+        return t.from_numpy(data[start:end].astype(np.float32) / INT16_SCALE)
@@ -0,0 +1,217 @@
+'''
+Export SimpleCNN to TorchScript and ONNX and run it with different backends.
+
+SimpleCNNGraph takes (mel_specs, segment_lengths) tensors as returned by Collate instead of
+a batch dict and has no Python control flow depending on the data, so it can be traced.
+Backends take the same tensors and return logits:
+
+eager        - SimpleCNNGraph in PyTorch
+torchscript  - traced graph saved with torch.jit.save
+onnx         - ONNX graph run with ONNX Runtime on CPU (needs the onnxruntime package)
+
+Running this file exports a checkpoint, checks that all backends give the same logits as
+the eager model and compares their latency and throughput on CPU.
+'''
+import os
+import time
+import click
+import numpy as np
+import torch as t
+from src.data.dataset import INDEX_TO_EBIRD_CODE
+from src.models.simple_cnn.model import SimpleCNN
+
+
+BACKENDS = ['eager', 'torchscript', 'onnx']
+TORCHSCRIPT_FILENAME = 'simple_cnn.torchscript.pt'
+ONNX_FILENAME = 'simple_cnn.onnx'
+
+
+class SimpleCNNGraph(t.nn.Module):
+    '''
+    SimpleCNN on tensors: mel_specs (batch_size x n_mels x n_segments * segment_size) and
+    segment_lengths (batch_size) -> logits (batch_size x n_classes).
+    All segments go through the CNN and padding segments are masked afterwards, the result
+    is the same as SimpleCNN.forward in eval mode.
+    segment_features: module used instead of model.segment_features, e.g. the int8 conv stack
+    from src/models/simple_cnn/quantize.py.
+    '''
+    def __init__(self, model, segment_features=None):
+        super().__init__()
+        self.model = model.eval()
+        self.segment_features = segment_features
+        self.n_mels = model.n_mels
+        self.segment_size = model.segment_size
+
+    def forward(self, mel_specs, segment_lengths):
+        batch_size = mel_specs.size(0)
+        segments = (
+            mel_specs
+            .reshape(batch_size, self.n_mels, -1, self.segment_size)
+            .permute(0, 2, 1, 3)
+            .reshape(-1, 1, self.n_mels, self.segment_size)
+        )
+        if self.segment_features is not None:
+            x = self.segment_features(segments)
+        else:
+            x = self.model.segment_features(segments)
+        x = x.reshape(batch_size, -1, x.size(1))
+        y = self.model.segment_frequency_features(segments)
+        y = y.reshape(batch_size, -1, y.size(1))
+
+        # Segment positions without arange, so the number of segments stays dynamic
+        positions = t.ones_like(x[:, :, 0]).cumsum(dim=1) - 1
+        segment_lengths = segment_lengths.reshape(-1, 1).to(x.dtype)
+        mask = (positions < segment_lengths).to(x.dtype).unsqueeze(-1)
+
+        return self.model.pool_segments(x * mask, y * mask, segment_lengths)
+
+
+def example_inputs(model, batch_size=2, n_segments=3):
+    '''Random batch with padding segments, the first item is full length as in Collate.'''
+    mel_specs = t.randn(batch_size, model.n_mels, n_segments * model.segment_size)
+    segment_lengths = t.randint(1, n_segments + 1, (batch_size,)).float()
+    segment_lengths[0] = n_segments
+    return mel_specs, segment_lengths
+
+
+def export_torchscript(model, path):
+    graph = SimpleCNNGraph(model)
+    with t.no_grad():
+        traced = t.jit.trace(graph, example_inputs(model))
+    t.jit.save(traced, path)
+
+
+def export_onnx(model, path, opset_version=13):
+    graph = SimpleCNNGraph(model)
+    with t.no_grad():
+        t.onnx.export(
+            graph,
+            example_inputs(model),
+            path,
+            input_names=['mel_specs', 'segment_lengths'],
+            output_names=['logits'],
+            dynamic_axes={
+                'mel_specs': {0: 'batch_size', 2: 'n_frames'},
+                'segment_lengths': {0: 'batch_size'},
+                'logits': {0: 'batch_size'},
+            },
+            opset_version=opset_version
+        )
+
+
+class EagerBackend:
+    def __init__(self, model):
+        self.graph = SimpleCNNGraph(model)
+
+    def __call__(self, mel_specs, segment_lengths):
+        with t.no_grad():
+            return self.graph(mel_specs, segment_lengths)
+
+
+class TorchScriptBackend:
+    def __init__(self, path):
+        self.graph = t.jit.load(path, map_location='cpu').eval()
+
+    def __call__(self, mel_specs, segment_lengths):
+        with t.no_grad():
+            return self.graph(mel_specs, segment_lengths)
+
+
+class OnnxBackend:
+    def __init__(self, path, n_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=['CPUExecutionProvider']
+        )
+
+    def __call__(self, mel_specs, segment_lengths):
+        logits, = self.session.run(None, {
+            'mel_specs': mel_specs.numpy().astype(np.float32),
+            'segment_lengths': segment_lengths.numpy().astype(np.float32),
+        })
+        return t.from_numpy(logits)
+
+
+def load_backend(backend, model=None, model_dir=None, n_threads=None):
+    '''model is used by the eager backend, exported files are read from model_dir.'''
+    if backend == 'eager':
+        return EagerBackend(model)
+    elif backend == 'torchscript':
+        return TorchScriptBackend(os.path.join(model_dir, TORCHSCRIPT_FILENAME))
+    elif backend == 'onnx':
+        return OnnxBackend(os.path.join(model_dir, ONNX_FILENAME), n_threads)
+    else:
+        raise ValueError(f'Unknown backend: {backend}')
+
+
+def benchmark(backend, mel_specs, segment_lengths, n_runs):
+    '''Mean seconds per call after one warm-up call.'''
+    backend(mel_specs, segment_lengths)
+    start_time = time.perf_counter()
+    for _ in range(n_runs):
+        backend(mel_specs, segment_lengths)
+    return (time.perf_counter() - start_time) / n_runs
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path())
+@click.option('--checkpoint_path', default=None, type=click.Path(exists=True),
+              help='Untrained model is exported if not given')
+@click.option('--batch_size', default=32, help='Batch size of the throughput benchmark')
+@click.option('--n_segments', default=4, help='Segments per item in the benchmark')
+@click.option('--n_runs', default=20)
+@click.option('--n_threads', default=1, help='CPU threads of every backend')
+@click.option('--tolerance', default=1e-4, help='Max abs difference of logits from eager')
+@click.option('--seed', default=123)
+def main(output_dir, checkpoint_path, batch_size, n_segments, n_runs, n_threads, tolerance,
+         seed):
+    t.set_num_threads(n_threads)
+    t.manual_seed(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if checkpoint_path is not None:
+        model = SimpleCNN.load_from_checkpoint(checkpoint_path, map_location='cpu')
+    else:
+        model = SimpleCNN(len(INDEX_TO_EBIRD_CODE), 128, 256)
+    model.eval()
+
+    export_torchscript(model, os.path.join(output_dir, TORCHSCRIPT_FILENAME))
+    export_onnx(model, os.path.join(output_dir, ONNX_FILENAME))
+    print(f'Exported to {output_dir}')
+
+    backends = {}
+    for name in BACKENDS:
+        try:
+            backends[name] = load_backend(name, model, output_dir, n_threads)
+        except ImportError as e:
+            print(f'Skipping {name}: {e}')
+
+    # Parity with SimpleCNN.forward on a batch with padding segments
+    mel_specs, segment_lengths = example_inputs(model, 8, n_segments)
+    with t.no_grad():
+        expected = model({'mel_specs': mel_specs, 'segment_lengths': segment_lengths})
+    failed = False
+    for name, backend in backends.items():
+        error = (backend(mel_specs, segment_lengths) - expected).abs().max().item()
+        status = 'ok' if error <= tolerance else 'FAILED'
+        failed = failed or error > tolerance
+        print(f'Parity {name:>11}: max abs error {error:.2e} {status}')
+
+    latency_inputs = example_inputs(model, 1, n_segments)
+    throughput_inputs = example_inputs(model, batch_size, n_segments)
+    print(f'Backend     | latency, ms (1 x {n_segments} segments) | '
+          f'throughput, items/sec ({batch_size} x {n_segments} segments)')
+    for name, backend in backends.items():
+        latency = benchmark(backend, *latency_inputs, n_runs)
+        throughput = batch_size / benchmark(backend, *throughput_inputs, n_runs)
+        print(f'{name:<11} | {latency * 1000:>33.2f} | {throughput:>39.1f}')
+
+    if failed:
+        raise click.ClickException('Exported model does not match the eager model')
+
+
+if __name__ == '__main__':
+    main()
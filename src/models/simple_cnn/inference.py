@@ -0,0 +1,236 @@
+'''
+Sliding-window inference of SimpleCNN on long recordings.
+
+A recording is decoded, resampled and mel transformed in chunks (see src/data/streaming.py).
+Segments of segment_size frames starting every stride frames are encoded by the CNN once
+as they arrive and only their features are kept. The prediction of a row of test.csv pools
+the features of the segments centered inside the row, so overlapping rows reuse the same
+segments instead of running the CNN on every window.
+'''
+import math
+import zipfile
+import numpy as np
+import torch as t
+from src.data.streaming import open_audio_stream, iter_resampled_chunks, iter_mel_chunks
+from src.models.simple_cnn.model import normalize_mel_spec
+
+
+# Extra file of the quantized conv stack with its quantized engine
+ENGINE_FILENAME = 'engine'
+
+
+def iter_segments(mel_chunks, segment_size, stride):
+    '''
+    Cut a stream of mel chunks (n_mels x frames) into segments starting every stride frames.
+    Yields n x n_mels x segment_size tensors. Frames after the last full segment get one more
+    segment padded with zeros, the same padding Collate uses.
+    '''
+    buffer = None
+    n_segments = 0
+    for mel_chunk in mel_chunks:
+        buffer = mel_chunk if buffer is None else t.cat((buffer, mel_chunk), dim=-1)
+        if buffer.size(-1) < segment_size:
+            continue
+        n = (buffer.size(-1) - segment_size) // stride + 1
+        yield buffer.unfold(-1, segment_size, stride)[:, :n].transpose(0, 1)
+        buffer = buffer[:, n * stride:]
+        n_segments += n
+
+    if buffer is None:
+        return
+    # Frames not covered by the last segment
+    if buffer.size(-1) > segment_size - stride or (n_segments == 0 and buffer.size(-1) > 0):
+        padded = t.zeros(buffer.size(0), segment_size)
+        padded[:, :buffer.size(-1)] = buffer
+        yield padded.unsqueeze(0)
+
+
+def iter_normalized_mel_chunks(filepath, sampling_rate, n_fft, n_mels, hop_length,
+                               normalization, chunk_duration=10):
+    '''
+    Normalized log mel chunks (n_mels x frames) of the first channel of a recording.
+    normalization: (min_log, max_log, mel_mean, mel_std) as used by normalize_mel_spec.
+    '''
+    old_sampling_rate, chunks = open_audio_stream(filepath, chunk_duration)
+    chunks = iter_resampled_chunks(chunks, old_sampling_rate, sampling_rate)
+    for mel_chunk in iter_mel_chunks(chunks, sampling_rate, n_fft, n_mels, hop_length):
+        yield normalize_mel_spec(mel_chunk[0], *normalization)
+
+
+def segment_ranges(frame_ranges, n_frames, n_segments, segment_size, stride):
+    '''
+    (first, last) segments of each (start, end) frame range, end=None means until the end
+    of the recording. A range without segment centers gets the closest segment.
+    '''
+    ranges = []
+    for start, end in frame_ranges:
+        end = n_frames if end is None else end
+        first = min(max(math.ceil((start - segment_size / 2) / stride), 0), n_segments)
+        last = min(max(math.ceil((end - segment_size / 2) / stride), 0), n_segments)
+        if last <= first:
+            closest = round(((start + end) / 2 - segment_size / 2) / stride)
+            first = min(max(closest, 0), n_segments - 1)
+            last = first + 1
+        ranges.append((first, last))
+    return ranges
+
+
+def load_conv_stack(path):
+    '''
+    Conv stack saved by quantize.py, a replacement of SimpleCNN.segment_features (CPU only).
+    The quantized engine is set to the one it was quantized for (fbgemm for older files)
+    before loading, since weights are packed for the current engine when they are loaded.
+    '''
+    with zipfile.ZipFile(path) as archive:
+        names = [x for x in archive.namelist() if x.endswith(f'/extra/{ENGINE_FILENAME}')]
+        engine = archive.read(names[0]).decode() if names else 'fbgemm'
+    if engine not in t.backends.quantized.supported_engines:
+        raise ValueError(f'{path} was quantized for {engine}, which this build does not support')
+    t.backends.quantized.engine = engine
+    return t.jit.load(path, map_location='cpu').eval()
+
+
+class SlidingWindowPredictor:
+    '''
+    model: SimpleCNN, mel spectrogram parameters of models with a front end are taken from it.
+    mel_stats: normalization statistics (see src/data/mel_stats.py) of models without
+    a front end.
+    stride: frames between starts of segments, half of the segment size by default.
+    segment_features: replacement of model.segment_features, e.g. the int8 conv stack saved
+    by src/models/simple_cnn/quantize.py and loaded with load_conv_stack.
+    channels_last: run the conv stack on channels-last segments.
+    '''
+    def __init__(self, model, mel_stats=None, normalization='minmax', sampling_rate=44100,
+                 n_fft=2048, hop_length=512, stride=None, batch_size=64, chunk_duration=10,
+                 segment_features=None, channels_last=False):
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.channels_last = channels_last
+        if channels_last:
+            self.model.to(memory_format=t.channels_last)
+        if segment_features is None:
+            segment_features = self.model.segment_features
+        self.segment_features = segment_features
+        self.segment_size = model.segment_size
+        self.stride = stride or model.segment_size // 2
+        self.batch_size = batch_size
+        self.chunk_duration = chunk_duration
+
+        if model.front_end is not None:
+            front_end = model.front_end
+            sampling_rate = front_end.mel_transform.sample_rate
+            n_fft = front_end.mel_transform.n_fft
+            hop_length = front_end.mel_transform.hop_length
+            self.normalization = (
+                front_end.min_log, front_end.max_log,
+                None if front_end.mel_mean is None else front_end.mel_mean.cpu(),
+                None if front_end.mel_std is None else front_end.mel_std.cpu()
+            )
+        elif normalization == 'standard':
+            self.normalization = (
+                mel_stats['min_log'], mel_stats['max_log'],
+                t.FloatTensor(mel_stats['mean']).view(-1, 1),
+                t.FloatTensor(mel_stats['std']).view(-1, 1)
+            )
+        else:
+            self.normalization = (mel_stats['min_log'], mel_stats['max_log'], None, None)
+        self.sampling_rate = sampling_rate
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def mel_params(self):
+        '''Arguments of iter_normalized_mel_chunks after filepath.'''
+        return (
+            self.sampling_rate, self.n_fft, self.model.n_mels, self.hop_length,
+            self.normalization, self.chunk_duration
+        )
+
+    def iter_mel_chunks(self, filepath):
+        return iter_normalized_mel_chunks(filepath, *self.mel_params())
+
+    def encode_segments(self, segments):
+        '''Features of n x n_mels x segment_size segments.'''
+        xs = []
+        ys = []
+        for i in range(0, segments.size(0), self.batch_size):
+            batch = segments[i:i + self.batch_size].unsqueeze(1).to(self.device)
+            if self.channels_last:
+                batch = batch.contiguous(memory_format=t.channels_last)
+            xs.append(self.segment_features(batch))
+            ys.append(self.model.segment_frequency_features(batch))
+        return t.cat(xs), t.cat(ys)
+
+    def encode(self, mel_chunks):
+        '''Returns features of all segments and number of frames of the recording.'''
+        n_frames = 0
+
+        def counted(mel_chunks):
+            nonlocal n_frames
+            for mel_chunk in mel_chunks:
+                n_frames += mel_chunk.size(-1)
+                yield mel_chunk
+
+        xs = []
+        ys = []
+        pending = []
+        n_pending = 0
+        with t.no_grad():
+            for segments in iter_segments(counted(mel_chunks), self.segment_size, self.stride):
+                pending.append(segments)
+                n_pending += segments.size(0)
+                # Segments of several chunks are encoded together to keep batches full
+                if n_pending >= self.batch_size:
+                    x, y = self.encode_segments(t.cat(pending))
+                    xs.append(x)
+                    ys.append(y)
+                    pending = []
+                    n_pending = 0
+            if pending:
+                x, y = self.encode_segments(t.cat(pending))
+                xs.append(x)
+                ys.append(y)
+
+        if not xs:
+            return None, None, 0
+        return t.cat(xs), t.cat(ys), n_frames
+
+    def pool(self, x, y, n_frames, frame_ranges):
+        '''Logits of each (start, end) frame range.'''
+        ranges = segment_ranges(frame_ranges, n_frames, x.size(0), self.segment_size, self.stride)
+        logits = []
+        with t.no_grad():
+            for first, last in ranges:
+                logits.append(self.model.pool_segments(
+                    x[first:last].unsqueeze(0),
+                    y[first:last].unsqueeze(0),
+                    t.full((1, 1), float(last - first), device=x.device)
+                ))
+        return t.cat(logits)
+
+    def frame_ranges(self, seconds):
+        '''
+        (start, end) frames of test.csv rows of one recording.
+        seconds: end of each row in seconds, rows start at the end of the previous row.
+        NaN means the whole recording.
+        '''
+        frames_per_second = self.sampling_rate / self.hop_length
+        frame_ranges = []
+        current_seconds = 0
+        for end_seconds in seconds:
+            if np.isnan(end_seconds):
+                frame_ranges.append((0, None))
+            else:
+                frame_ranges.append((
+                    int(current_seconds * frames_per_second),
+                    int(end_seconds * frames_per_second)
+                ))
+                current_seconds = end_seconds
+        return frame_ranges
+
+    def predict(self, filepath, seconds):
+        '''Probabilities (rows x classes) of test.csv rows of one recording.'''
+        frame_ranges = self.frame_ranges(seconds)
+        x, y, n_frames = self.encode(self.iter_mel_chunks(filepath))
+        if x is None:
+            return np.zeros((len(frame_ranges), self.model.n_classes), dtype=np.float32)
+        return t.sigmoid(self.pool(x, y, n_frames, frame_ranges)).cpu().numpy()
@@ -4,19 +4,81 @@ Trains on full audio length.
 '''
 import numpy as np
 import torch as t
+import torchaudio as toa
 import pytorch_lightning as pl
 from itertools import chain
 from sklearn.metrics import roc_auc_score, average_precision_score
 from src.data.dataset import EBIRD_CODE_TO_INDEX
+from src.data.transforms import BatchMasking, BatchCompose
+
+
+def normalize_mel_spec(mel_spec, min_log, max_log, mel_mean=None, mel_std=None):
+    mel_spec = t.log(mel_spec + 0.0001)
+    if mel_mean is not None:
+        return (mel_spec - mel_mean) / (mel_std + 0.0001)
+    return (mel_spec - min_log) / (min_log - max_log)
+
+
+class MelFrontEnd(t.nn.Module):
+    '''
+    Padded waveforms (batch_size x samples) -> normalized log mel spectrograms
+    (batch_size x n_mels x frames) with zero padding, the same as prepare_data.py and Collate
+    compute them. Has no trainable parameters.
+    time_mask/freq_mask: max width of time/frequency masks applied in training mode.
+    '''
+    def __init__(self, sampling_rate, n_fft, n_mels, hop_length, min_log, max_log,
+                 mel_mean=None, mel_std=None, time_mask=0, freq_mask=0):
+        super().__init__()
+        self.mel_transform = toa.transforms.MelSpectrogram(
+            sample_rate=sampling_rate,
+            n_fft=n_fft,
+            n_mels=n_mels,
+            hop_length=hop_length,
+        )
+        self.min_log = min_log
+        self.max_log = max_log
+        if mel_mean is not None:
+            self.register_buffer('mel_mean', t.FloatTensor(mel_mean).view(-1, 1))
+            self.register_buffer('mel_std', t.FloatTensor(mel_std).view(-1, 1))
+        else:
+            self.mel_mean = None
+            self.mel_std = None
+        augment = []
+        if time_mask > 0:
+            augment.append(BatchMasking(time_mask, 2))
+        if freq_mask > 0:
+            augment.append(BatchMasking(freq_mask, 1))
+        self.augment = BatchCompose(augment)
+
+    def forward(self, waveforms, lengths):
+        '''lengths: lengths of the mel spectrograms in frames.'''
+        with t.no_grad():
+            mel_specs = self.mel_transform(waveforms)
+            if self.training:
+                mel_specs, lengths = self.augment(mel_specs, lengths)
+            mel_specs = normalize_mel_spec(
+                mel_specs, self.min_log, self.max_log, self.mel_mean, self.mel_std
+            )
+            mask = t.arange(mel_specs.size(2), device=mel_specs.device).unsqueeze(0)
+            mask = mask < lengths.to(mel_specs.device).unsqueeze(1)
+            return mel_specs * mask.unsqueeze(1)
 
 
 class SimpleCNN(pl.LightningModule):
     '''
     Input: batch_size x n_mels x segment_size
     Output: batch_size x n_classes
+    front_end: keyword arguments of MelFrontEnd to train on batches of waveforms
+    (see WaveformCollate) instead of mel spectrograms.
+    normalization: statistics (min_log, max_log, mean, std), stats_path and mode of the
+    normalization of saved mel spectrograms the model is trained on, read back at inference.
     '''
-    def __init__(self, n_classes, n_mels, segment_size, lr=0.001):
+    def __init__(self, n_classes, n_mels, segment_size, lr=0.001, front_end=None,
+                 normalization=None):
         super().__init__()
+        self.front_end = None if front_end is None else MelFrontEnd(**front_end)
+        self.normalization = normalization
+
         self.conv_1 = t.nn.Conv2d(1, 64, (5, 5), padding=(2, 2))
         self.bn_1 = t.nn.BatchNorm2d(64)
         self.maxpool_1 = t.nn.MaxPool2d((4, 3))
@@ -51,20 +113,9 @@ class SimpleCNN(pl.LightningModule):
         # self.loss_fn = t.nn.CrossEntropyLoss()
         self.save_hyperparameters()
 
-    def forward(self, batch):
-        batch_size = len(batch['mel_specs'])
-        n_segments = int(max(batch['segment_lengths']))
-        mel_specs = batch['mel_specs']
-
-        mel_specs = (
-            mel_specs
-            .transpose(-2, -1)
-            .reshape(n_segments * batch_size, 1, -1, self.n_mels)
-            .transpose(-2, -1)
-        )
-
-        # Mel features
-        x = self.conv_1(mel_specs)
+    def segment_features(self, segments):
+        '''segments: n x 1 x n_mels x segment_size -> n x features'''
+        x = self.conv_1(segments)
         x = self.bn_1(x)
         x = self.maxpool_1(x)
         x = t.relu(x)
@@ -83,32 +134,61 @@ class SimpleCNN(pl.LightningModule):
         x = self.bn_4(x)
         x = self.maxpool_4(x)
 
+        # reshape, not view, so channels-last inputs work too
+        return x.reshape(x.size(0), -1)
+
+    def forward(self, batch):
+        if 'waveforms' in batch:
+            mel_specs = self.front_end(batch['waveforms'], t.LongTensor(batch['original_lengths']))
+        else:
+            mel_specs = batch['mel_specs']
+        batch_size = len(mel_specs)
+        n_segments = int(max(batch['segment_lengths']))
+
+        mel_specs = (
+            mel_specs
+            .transpose(-2, -1)
+            .reshape(n_segments * batch_size, 1, -1, self.n_mels)
+            .transpose(-2, -1)
+        )
+
+        segment_lengths = batch['segment_lengths'].to(mel_specs.device).view(-1, 1)
+        segment_mask = (
+            t.arange(n_segments, device=mel_specs.device).unsqueeze(0) < segment_lengths
+        )
+
+        # Mel features of real segments only, padding segments stay zero
+        packed_mask = segment_mask.view(-1)
+        packed_x = self.segment_features(mel_specs[packed_mask])
+        x = packed_x.new_zeros(n_segments * batch_size, packed_x.size(1))
+        x[packed_mask] = packed_x
+
         x = x.view(batch_size, n_segments, -1)
         x = self.dropout(x)
 
         # Frequency features
-        y = t.sum(mel_specs.view(batch_size, n_segments, self.n_mels, -1), dim=-1)
-        # print('y.shape beginning: ', y.shape)
+        y = self.segment_frequency_features(mel_specs).view(batch_size, n_segments, -1)
+        y = y * segment_mask.unsqueeze(-1)
+
+        return self.pool_segments(x, y, segment_lengths)
+
+    def segment_frequency_features(self, segments):
+        '''segments: n x 1 x n_mels x segment_size -> n x features'''
+        y = t.sum(segments.view(segments.size(0), self.n_mels, -1), dim=-1)
         y_max, _ = t.max(y, dim=-1)
         y_min, _ = t.min(y, dim=-1)
         y_max = y_max.unsqueeze(-1)
         y_min = y_min.unsqueeze(-1)
 
-        # print('y_max.shape: ', y_max.shape)
-        # print('y_min.shape: ', y_min.shape)
-
         y = (y - y_min) / (y_max - y_min + 0.0001)
-        y = self.linear_y(y)
-
-        # print('y.shape after linear: ', y.shape)
-
-        # Global avg/max pooling
-        segment_lengths = batch['segment_lengths'].view(-1, 1)
-
-        for i in range(x.size(0)):
-            x[i, int(segment_lengths[i].item()):, :] = 0
-            y[i, int(segment_lengths[i].item()):, :] = 0
-
+        return self.linear_y(y)
+
+    def pool_segments(self, x, y, segment_lengths):
+        '''
+        Global avg/max pooling of segment features and classification.
+        x, y: batch_size x n_segments x features, zero for padding segments.
+        segment_lengths: batch_size x 1
+        '''
         x1 = t.sum(x, dim=1)
         x1 = x1 / segment_lengths
         x2, _ = t.max(x, dim=1)
@@ -117,19 +197,9 @@ class SimpleCNN(pl.LightningModule):
         y1 = y1 / segment_lengths
         y2, _ = t.max(y, dim=1)
 
-        # print('y1.shape: ', y1.shape)
-        # print('y2.shape: ', y2.shape)
-
         z = t.cat((x1, x2, y1, y2), dim=-1)
 
-        z = self.linear(z)
-
-        # z = self.linear_1(z)
-        # z = t.relu(z)
-        # z = self.dropout(z)
-        # z = self.linear_2(z)
-
-        return z
+        return self.linear(z)
 
     def training_step(self, batch, batch_idx):
         prediction = self(batch)
@@ -275,48 +345,139 @@ class SimpleCNN(pl.LightningModule):
 
 
 class Collate:
-    def __init__(self, n_frames, min_log, max_log):
+    '''
+    Pad mel spectrograms to a multiple of n_frames and normalize log mel spectrograms.
+    Uses min_log/max_log range by default or per mel bin mel_mean/mel_std if given.
+    mixup: optional batch transform applied to padded spectrograms before normalization,
+    e.g. BatchSpecMixup from src/data/transforms.py.
+    augment: optional batch augmentation applied after mixup, e.g. BatchCompose of
+    BatchRandomTimeShift, BatchRandomTimeResize and BatchMasking.
+    '''
+    def __init__(self, n_frames, min_log, max_log, mel_mean=None, mel_std=None, mixup=None,
+                 augment=None):
         self.min_log = min_log
         self.max_log = max_log
         self.n_frames = n_frames
+        self.mel_mean = None if mel_mean is None else t.FloatTensor(mel_mean).view(-1, 1)
+        self.mel_std = None if mel_std is None else t.FloatTensor(mel_std).view(-1, 1)
+        self.mixup = mixup
+        self.augment = augment
+
+    @classmethod
+    def from_stats(cls, n_frames, mel_stats, normalization='minmax', mixup=None,
+                   augment=None):
+        '''Create from statistics saved by prepare_data.py (see src/data/mel_stats.py).'''
+        if normalization == 'minmax':
+            return cls(
+                n_frames, mel_stats['min_log'], mel_stats['max_log'],
+                mixup=mixup, augment=augment
+            )
+        elif normalization == 'standard':
+            return cls(
+                n_frames, mel_stats['min_log'], mel_stats['max_log'],
+                mel_stats['mean'], mel_stats['std'], mixup, augment
+            )
+        else:
+            raise ValueError(f'Unknown normalization: {normalization}')
+
+    def normalize(self, mel_spec):
+        return normalize_mel_spec(
+            mel_spec, self.min_log, self.max_log, self.mel_mean, self.mel_std
+        )
 
     def __call__(self, batch):
         batch_size = len(batch)
 
-        lengths = [x['mel_spec'].size(1) for x in batch]
-        max_length = max(lengths)
-
-        k = (max_length // self.n_frames) + 1
-        padded_length = k * self.n_frames
-
+        lengths = t.LongTensor([x['mel_spec'].size(1) for x in batch])
         n_mels = batch[0]['mel_spec'].size(0)
 
-        batched_mels = t.zeros(batch_size, n_mels, padded_length)
+        mel_specs = t.zeros(batch_size, n_mels, int(lengths.max()))
+        for i, item in enumerate(batch):
+            mel_specs[i, :, :item['mel_spec'].size(1)] = item['mel_spec']
 
-        segment_lengths = t.FloatTensor([(length // self.n_frames) + 1 for length in lengths])
+        encoded_ebird_codes = t.cat([x['encoded_ebird_codes'].view(1, -1) for x in batch], dim=0)
 
         with t.no_grad():
-            for i, item in enumerate(batch):
-                mel_spec = t.log(item['mel_spec'] + 0.0001)
-                mel_spec = (mel_spec - self.min_log) / (self.min_log - self.max_log)
-                batched_mels[i, :, :mel_spec.size(1)] = mel_spec
+            if self.mixup is not None:
+                mel_specs, lengths, encoded_ebird_codes = self.mixup(
+                    mel_specs, lengths, encoded_ebird_codes
+                )
+            if self.augment is not None:
+                mel_specs, lengths = self.augment(mel_specs, lengths)
+            max_length = int(lengths.max())
+
+            # Number of segments is rounded up, lengths that are multiples of n_frames
+            # (e.g. fixed-length crops) do not get an extra segment of padding
+            k = max(int(np.ceil(max_length / self.n_frames)), 1)
+            padded_length = k * self.n_frames
+
+            batched_mels = t.zeros(batch_size, n_mels, padded_length)
+            mask = t.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)
+            batched_mels[:, :, :max_length] = (
+                self.normalize(mel_specs[:, :, :max_length]) * mask.unsqueeze(1)
+            )
+
+        segment_lengths = (lengths.float() / self.n_frames).ceil().clamp(min=1)
+        lengths = lengths.tolist()
+
+        return dict(
+            collate_labels(batch),
+            mel_specs=batched_mels,
+            original_lengths=lengths,
+            encoded_ebird_codes=encoded_ebird_codes,
+            segment_lengths=segment_lengths,
+        )
+
+
+def collate_labels(batch):
+    return {
+        'primary_ebird_codes': [x['primary_ebird_code'] for x in batch],
+        'secondary_ebird_codes': list(chain(*[x['secondary_ebird_codes'] for x in batch])),
+        'primary_labels': [x['primary_label'] for x in batch],
+        'secondary_labels': [x['secondary_labels'] for x in batch],
+        'durations': [x['duration'] for x in batch],
+    }
+
+
+class WaveformCollate:
+    '''
+    Pad waveforms so that their mel spectrograms computed by MelFrontEnd (centered frames with
+    hop_length) have a multiple of n_frames frames.
+    mixup: optional batch transform applied to padded waveforms, e.g. BatchSpecMixup.
+    '''
+    def __init__(self, n_frames, hop_length, mixup=None):
+        self.n_frames = n_frames
+        self.hop_length = hop_length
+        self.mixup = mixup
+
+    def __call__(self, batch):
+        batch_size = len(batch)
 
-        primary_labels = [x['primary_label'] for x in batch]
-        secondary_labels = [x['secondary_labels'] for x in batch]
-        durations = [x['duration'] for x in batch]
+        lengths = t.LongTensor([x['waveform'].size(0) for x in batch])
+        waveforms = t.zeros(batch_size, 1, int(lengths.max()))
+        for i, item in enumerate(batch):
+            waveforms[i, 0, :item['waveform'].size(0)] = item['waveform']
 
         encoded_ebird_codes = t.cat([x['encoded_ebird_codes'].view(1, -1) for x in batch], dim=0)
-        primary_ebird_codes = [x['primary_ebird_code'] for x in batch]
-        secondary_ebird_codes = list(chain(*[x['secondary_ebird_codes'] for x in batch]))
 
-        return {
-            'mel_specs': batched_mels,
-            'original_lengths': lengths,
-            'encoded_ebird_codes': encoded_ebird_codes,
-            'primary_ebird_codes': primary_ebird_codes,
-            'secondary_ebird_codes': secondary_ebird_codes,
-            'primary_labels': primary_labels,
-            'secondary_labels': secondary_labels,
-            'segment_lengths': segment_lengths,
-            'durations': durations,
-        }
+        with t.no_grad():
+            if self.mixup is not None:
+                waveforms, lengths, encoded_ebird_codes = self.mixup(
+                    waveforms, lengths, encoded_ebird_codes
+                )
+
+        frame_lengths = lengths // self.hop_length + 1
+        k = max(int(np.ceil(int(frame_lengths.max()) / self.n_frames)), 1)
+        # Largest number of samples that still gives k * n_frames centered frames
+        padded_length = k * self.n_frames * self.hop_length - 1
+        batched_waveforms = t.zeros(batch_size, padded_length)
+        n_samples = min(waveforms.size(2), padded_length)
+        batched_waveforms[:, :n_samples] = waveforms[:, 0, :n_samples]
+
+        return dict(
+            collate_labels(batch),
+            waveforms=batched_waveforms,
+            original_lengths=frame_lengths.tolist(),
+            encoded_ebird_codes=encoded_ebird_codes,
+            segment_lengths=(frame_lengths.float() / self.n_frames).ceil().clamp(min=1),
+        )
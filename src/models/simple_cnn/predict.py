@@ -0,0 +1,344 @@
+'''
+Write a submission csv (row_id,birds) for test.csv with a trained SimpleCNN.
+
+Recordings are decoded and mel transformed in a process pool (see src/data/scheduler.py),
+their segments are encoded by the model in batches of batch_size segments taken across
+recordings and rows are pooled as in src/models/simple_cnn/inference.py. With --backend rows
+are run through a backend from src/models/simple_cnn/export.py instead.
+
+With --synthetic n a test set of n noise recordings is generated first, so throughput can
+be measured on any machine:
+
+python src/models/simple_cnn/predict.py synthetic/test.csv synthetic/audio submission.csv \
+    --synthetic 20
+
+test_csv_path must not exist and audio_dir must be empty or new.
+'''
+import os
+import time
+import click
+import numpy as np
+import pandas as pd
+import torch as t
+import torchaudio as toa
+from pathlib import Path
+from src.data.dataset import INDEX_TO_EBIRD_CODE, RecordingRows
+from src.data.mel_stats import read_mel_stats
+from src.data.scheduler import MemoryBoundedScheduler, PermanentError
+from src.models.simple_cnn.export import (
+    BACKENDS, ONNX_FILENAME, TORCHSCRIPT_FILENAME, load_backend
+)
+from src.models.simple_cnn.inference import (
+    SlidingWindowPredictor, iter_normalized_mel_chunks, iter_segments, load_conv_stack,
+    segment_ranges
+)
+from src.models.simple_cnn.model import SimpleCNN
+
+
+def decode_recording(filepath, mel_params):
+    '''Normalized log mel spectrogram (n_mels x frames) of a recording.'''
+    try:
+        mel_chunks = list(iter_normalized_mel_chunks(filepath, *mel_params))
+    except RuntimeError as e:
+        raise PermanentError(f'Failed to load: {filepath}: {e}')
+    if not mel_chunks:
+        return None
+    return t.cat(mel_chunks, dim=-1)
+
+
+class BatchedSegmentEncoder:
+    '''
+    Encode segments of many recordings in batches of batch_size segments.
+    Features of a recording are passed to on_done(key, x, y) once all its segments are encoded.
+    '''
+    def __init__(self, predictor, batch_size, on_done):
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.on_done = on_done
+        self.queue = []
+        self.n_queued = 0
+        self.features = {}
+        self.remaining = {}
+
+    def add(self, key, segments):
+        self.queue.append((key, segments))
+        self.n_queued += segments.size(0)
+        self.features[key] = []
+        self.remaining[key] = segments.size(0)
+        self.flush(final=False)
+
+    def flush(self, final=True):
+        while self.n_queued >= self.batch_size or (final and self.n_queued > 0):
+            pieces = []
+            n = 0
+            while self.queue and n < self.batch_size:
+                key, segments = self.queue[0]
+                k = min(self.batch_size - n, segments.size(0))
+                pieces.append((key, segments[:k]))
+                if k == segments.size(0):
+                    self.queue.pop(0)
+                else:
+                    self.queue[0] = (key, segments[k:])
+                n += k
+            self.n_queued -= n
+
+            with t.no_grad():
+                x, y = self.predictor.encode_segments(t.cat([x for _, x in pieces]))
+
+            offset = 0
+            for key, segments in pieces:
+                k = segments.size(0)
+                self.features[key].append((x[offset:offset + k], y[offset:offset + k]))
+                offset += k
+                self.remaining[key] -= k
+                if self.remaining[key] == 0:
+                    features = self.features.pop(key)
+                    del self.remaining[key]
+                    self.on_done(
+                        key, t.cat([x for x, _ in features]), t.cat([y for _, y in features])
+                    )
+
+
+def backend_logits(backend, predictor, segments, n_frames, frame_ranges, batch_size):
+    '''
+    Logits of each (start, end) frame range with a backend from export.py. Every row is an
+    item of the segments centered inside it, the same segments predictor.pool uses, but
+    segments of overlapping rows are encoded once per row.
+    '''
+    segment_size = predictor.segment_size
+    ranges = segment_ranges(frame_ranges, n_frames, segments.size(0), segment_size,
+                            predictor.stride)
+    lengths = [last - first for first, last in ranges]
+    logits = []
+    start = 0
+    while start < len(ranges):
+        # Rows are padded to the longest one, at most batch_size segments per call
+        end = start + 1
+        while end < len(ranges) and max(lengths[start:end + 1]) * (end + 1 - start) <= batch_size:
+            end += 1
+        mel_specs = segments.new_zeros(
+            end - start, segments.size(1), max(lengths[start:end]) * segment_size
+        )
+        for j, (first, last) in enumerate(ranges[start:end]):
+            mel_specs[j, :, :(last - first) * segment_size] = (
+                segments[first:last].permute(1, 0, 2).reshape(segments.size(1), -1)
+            )
+        segment_lengths = t.FloatTensor(lengths[start:end])
+        logits.append(
+            backend(mel_specs.to(predictor.device), segment_lengths.to(predictor.device)).cpu()
+        )
+        start = end
+    return t.cat(logits)
+
+
+def read_thresholds(thresholds_path, default_threshold):
+    '''Per class thresholds from a csv with ebird_code and threshold columns.'''
+    thresholds = np.full(len(INDEX_TO_EBIRD_CODE), default_threshold, dtype=np.float32)
+    if thresholds_path is not None:
+        thresholds_df = pd.read_csv(thresholds_path)
+        index = {x: i for i, x in enumerate(INDEX_TO_EBIRD_CODE)}
+        for ebird_code, threshold in zip(thresholds_df['ebird_code'], thresholds_df['threshold']):
+            thresholds[index[ebird_code]] = threshold
+    return thresholds
+
+
+def birds_string(probabilities, thresholds):
+    birds = [INDEX_TO_EBIRD_CODE[i] for i in np.nonzero(probabilities >= thresholds)[0]]
+    return ' '.join(birds) if birds else 'nocall'
+
+
+def model_mel_stats(model, stats_path, normalization, allow_default):
+    '''
+    Normalization statistics and mode of a model without a front end: those recorded in its
+    checkpoint, else those of stats_path. allow_default: fall back to the range of
+    log(mel + 0.0001) when neither is there, e.g. for untrained models or synthetic runs.
+    '''
+    if model.normalization is not None:
+        return model.normalization, model.normalization['mode']
+    if stats_path is not None and os.path.exists(stats_path):
+        return read_mel_stats(stats_path), normalization
+    if not allow_default:
+        raise click.UsageError(
+            'The checkpoint does not record its normalization statistics, give the '
+            f'--stats_path it was trained with (not found: {stats_path})'
+        )
+    if normalization == 'standard':
+        raise click.UsageError('--normalization standard needs --stats_path')
+    return {'min_log': float(np.log(0.0001)), 'max_log': 10.}, normalization
+
+
+def make_synthetic_test_set(test_csv_path, audio_dir, n_recordings, duration=600,
+                            sampling_rate=32000):
+    '''Noise recordings with test.csv rows like site_1/site_2 (5 s rows) and site_3 (whole).'''
+    Path(test_csv_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(audio_dir).mkdir(parents=True, exist_ok=True)
+    rows = []
+    for i in range(n_recordings):
+        audio_id = f'synthetic_{i:04d}'
+        waveform = t.rand(1, duration * sampling_rate) * 0.2 - 0.1
+        toa.save(os.path.join(audio_dir, f'{audio_id}.mp3'), waveform, sampling_rate)
+        if i % 3 == 2:
+            rows.append({
+                'site': 'site_3', 'row_id': f'site_3_{audio_id}', 'seconds': None,
+                'audio_id': audio_id
+            })
+        else:
+            site = f'site_{i % 3 + 1}'
+            rows.extend(
+                {
+                    'site': site, 'row_id': f'{site}_{audio_id}_{seconds}',
+                    'seconds': seconds, 'audio_id': audio_id
+                }
+                for seconds in range(5, duration + 1, 5)
+            )
+    pd.DataFrame(rows).to_csv(test_csv_path, index=False)
+
+
+@click.command()
+@click.argument('test_csv_path', type=click.Path())
+@click.argument('audio_dir', type=click.Path())
+@click.argument('output_path', type=click.Path())
+@click.option('--checkpoint_path', default=None, type=click.Path(exists=True),
+              help='Untrained model is used if not given, e.g. to measure throughput')
+@click.option('--stats_path', default=None, type=click.Path(),
+              help='Normalization statistics the model was trained with, e.g. '
+                   'mel_stats_fold_0_of_5.json for a model validated on fold 0, only used '
+                   'for checkpoints that do not record them')
+@click.option('--normalization', type=click.Choice(['minmax', 'standard']), default='minmax',
+              help='Used with --stats_path')
+@click.option('--target_sampling_rate', default=44100)
+@click.option('--stride', default=None, type=int, help='Frames between segments')
+@click.option('--batch_size', default=256, help='Segments per model call')
+@click.option('--n_jobs', default=4, help='Processes decoding recordings')
+@click.option('--n_threads', default=1, help='Torch threads of every decoding process')
+@click.option('--model_threads', default=None, type=int,
+              help='Torch threads of the model, by default cores left by decoding processes')
+@click.option('--memory_budget_gb', default=8.)
+@click.option('--memory_factor', default=80.,
+              help='Estimated memory needed to decode a recording per byte of mp3')
+@click.option('--threshold', default=0.5)
+@click.option('--thresholds_path', default=None, type=click.Path(exists=True),
+              help='csv with per class ebird_code and threshold columns')
+@click.option('--device', default='cpu')
+@click.option('--quantized_path', default=None, type=click.Path(exists=True),
+              help='Int8 conv stack saved by quantize.py, used instead of the float one (CPU only)')
+@click.option('--channels_last', is_flag=True, help='Run the conv stack on channels-last inputs')
+@click.option('--backend', type=click.Choice(BACKENDS), default=None,
+              help='Run every row through a backend of export.py instead of pooling segment '
+                   'features shared by overlapping rows')
+@click.option('--model_dir', default='./models/exported',
+              help='Files exported by export.py from the same checkpoint, for --backend '
+                   'torchscript and onnx')
+@click.option('--synthetic', default=0, help='Generate a test set of this many recordings first')
+def main(test_csv_path, audio_dir, output_path, checkpoint_path, stats_path, normalization,
+         target_sampling_rate, stride, batch_size, n_jobs, n_threads, model_threads,
+         memory_budget_gb, memory_factor, threshold, thresholds_path, device, quantized_path,
+         channels_last, backend, model_dir, synthetic):
+    if quantized_path is not None and device != 'cpu':
+        raise click.UsageError('--quantized_path works only with --device cpu')
+    if backend is not None and (quantized_path is not None or channels_last):
+        raise click.UsageError('--backend does not work with --quantized_path and --channels_last')
+    if backend in ['torchscript', 'onnx']:
+        if device != 'cpu':
+            raise click.UsageError(f'--backend {backend} works only with --device cpu')
+        filename = TORCHSCRIPT_FILENAME if backend == 'torchscript' else ONNX_FILENAME
+        if not os.path.exists(os.path.join(model_dir, filename)):
+            raise click.UsageError(f'No {filename} in {model_dir}, run export.py first')
+    if synthetic > 0:
+        # Never overwrite a real test set
+        if os.path.exists(test_csv_path) or (os.path.isdir(audio_dir) and os.listdir(audio_dir)):
+            raise click.UsageError(
+                '--synthetic writes a new test set, give a test_csv_path that does not exist '
+                'and an empty or new audio_dir'
+            )
+        make_synthetic_test_set(test_csv_path, audio_dir, synthetic)
+    if model_threads is None:
+        model_threads = max((os.cpu_count() or 1) - n_jobs * n_threads, 1)
+    t.set_num_threads(model_threads)
+
+    if checkpoint_path is not None:
+        model = SimpleCNN.load_from_checkpoint(checkpoint_path, map_location=device)
+    else:
+        model = SimpleCNN(len(INDEX_TO_EBIRD_CODE), 128, 256)
+    model = model.to(device)
+
+    mel_stats = None
+    if model.front_end is None:
+        mel_stats, normalization = model_mel_stats(
+            model, stats_path, normalization, checkpoint_path is None or synthetic > 0
+        )
+    predictor = SlidingWindowPredictor(
+        model, mel_stats, normalization, target_sampling_rate, stride=stride,
+        batch_size=batch_size,
+        segment_features=None if quantized_path is None else load_conv_stack(quantized_path),
+        channels_last=channels_last
+    )
+    if backend is not None:
+        try:
+            backend = load_backend(backend, model, model_dir, model_threads)
+        except ImportError as e:
+            raise click.UsageError(f'--backend {backend} needs the onnxruntime package: {e}')
+    thresholds = read_thresholds(thresholds_path, threshold)
+
+    recordings = RecordingRows(pd.read_csv(test_csv_path))
+    filepaths = [os.path.join(audio_dir, f'{x}.mp3') for x in recordings.audio_ids]
+    predictions = {}
+    n_frames = {}
+
+    def on_done(i, x, y):
+        frame_ranges = predictor.frame_ranges(recordings.seconds[recordings.rows(i)])
+        logits = predictor.pool(x, y, n_frames.pop(i), frame_ranges)
+        predictions[i] = t.sigmoid(logits).cpu().numpy()
+
+    encoder = BatchedSegmentEncoder(predictor, batch_size, on_done)
+    scheduler = MemoryBoundedScheduler(
+        n_jobs, memory_budget_gb * 2 ** 30, max_retries=0, n_threads=n_threads
+    )
+    jobs = []
+    for i, filepath in enumerate(filepaths):
+        if not os.path.exists(filepath):
+            scheduler.add_failure(i, PermanentError(f'Missing: {filepath}'), 0)
+            continue
+        jobs.append(
+            (i, (filepath, predictor.mel_params()), os.path.getsize(filepath) * memory_factor)
+        )
+
+    start_time = time.perf_counter()
+    audio_seconds = 0.
+    for i, mel_spec in scheduler.run(decode_recording, jobs):
+        if mel_spec is None:
+            continue
+        n_frames[i] = mel_spec.size(-1)
+        audio_seconds += mel_spec.size(-1) * predictor.hop_length / predictor.sampling_rate
+        segments = t.cat(list(iter_segments(iter([mel_spec]), predictor.segment_size,
+                                            predictor.stride)))
+        if backend is None:
+            encoder.add(i, segments)
+        else:
+            frame_ranges = predictor.frame_ranges(recordings.seconds[recordings.rows(i)])
+            logits = backend_logits(
+                backend, predictor, segments, n_frames.pop(i), frame_ranges, batch_size
+            )
+            predictions[i] = t.sigmoid(logits).numpy()
+    encoder.flush()
+    elapsed = time.perf_counter() - start_time
+
+    # Recordings that are missing, failed to decode or are empty get no birds
+    submission = []
+    for i in range(len(recordings)):
+        rows = recordings.rows(i)
+        if i in predictions:
+            birds = [birds_string(x, thresholds) for x in predictions[i]]
+        else:
+            birds = ['nocall'] * (rows.stop - rows.start)
+        submission.extend(zip(recordings.row_ids[rows], birds))
+    pd.DataFrame(submission, columns=['row_id', 'birds']).to_csv(output_path, index=False)
+
+    print(f'Recordings: {len(predictions)} of {len(recordings)}, '
+          f'failed: {len(scheduler.failures)}')
+    print(f'{len(predictions) / elapsed:.2f} recordings/sec, '
+          f'{audio_seconds / elapsed:.1f} audio seconds/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+'''
+Int8 and channels-last CPU inference of the SimpleCNN conv stack.
+
+The conv stack (SimpleCNN.segment_features) is where almost all inference time goes.
+ConvStack is a copy of it with conv_N/bn_N pairs fused and ReLU moved in front of max pooling
+(they commute), so layers 1-3 fuse into conv + bn + relu. It is quantized to int8 with post
+training static quantization calibrated on segments of prepared mel spectrograms and saved
+as a TorchScript file that can replace segment_features at inference:
+
+python src/models/simple_cnn/predict.py test.csv audio submission.csv \
+    --checkpoint_path model.ckpt --quantized_path simple_cnn_conv_int8.pt
+
+Running this file quantizes a checkpoint, reports the per class ROC AUC change against the
+float model on the validation fold and the speedup of the conv stack.
+'''
+import copy
+import os
+import time
+import click
+import numpy as np
+import pandas as pd
+import torch as t
+from sklearn.metrics import roc_auc_score
+from src.data.dataset import BirdMelTrainDataset, INDEX_TO_EBIRD_CODE
+from src.data.folds import load_folds
+from src.data.mel_stats import fold_stats_filename, read_mel_stats
+from src.models.simple_cnn.export import SimpleCNNGraph
+from src.models.simple_cnn.inference import ENGINE_FILENAME
+from src.models.simple_cnn.model import SimpleCNN, Collate
+
+
+QUANTIZED_FILENAME = 'simple_cnn_conv_int8.pt'
+FUSED_LAYERS = [
+    ['conv_1', 'bn_1', 'relu_1'],
+    ['conv_2', 'bn_2', 'relu_2'],
+    ['conv_3', 'bn_3', 'relu_3'],
+    ['conv_4', 'bn_4'],
+]
+
+
+class ConvStack(t.nn.Module):
+    '''
+    Same output as model.segment_features with fused conv_N/bn_N pairs.
+    Quant/dequant stubs are no-ops until the stack is quantized.
+    channels_last: convert segments to channels-last memory format first.
+    '''
+    def __init__(self, model, channels_last=False):
+        super().__init__()
+        self.channels_last = channels_last
+        self.quant = t.quantization.QuantStub()
+        self.dequant = t.quantization.DeQuantStub()
+        for i in range(1, 5):
+            setattr(self, f'conv_{i}', copy.deepcopy(getattr(model, f'conv_{i}')))
+            setattr(self, f'bn_{i}', copy.deepcopy(getattr(model, f'bn_{i}')))
+            setattr(self, f'maxpool_{i}', copy.deepcopy(getattr(model, f'maxpool_{i}')))
+        self.relu_1 = t.nn.ReLU()
+        self.relu_2 = t.nn.ReLU()
+        self.relu_3 = t.nn.ReLU()
+        self.eval()
+        t.quantization.fuse_modules(self, FUSED_LAYERS, inplace=True)
+        if channels_last:
+            self.to(memory_format=t.channels_last)
+
+    def forward(self, segments):
+        if self.channels_last:
+            segments = segments.contiguous(memory_format=t.channels_last)
+        x = self.quant(segments)
+        x = self.maxpool_1(self.relu_1(self.bn_1(self.conv_1(x))))
+        x = self.maxpool_2(self.relu_2(self.bn_2(self.conv_2(x))))
+        x = self.maxpool_3(self.relu_3(self.bn_3(self.conv_3(x))))
+        x = self.maxpool_4(self.bn_4(self.conv_4(x)))
+        x = self.dequant(x)
+        return x.reshape(x.size(0), -1)
+
+
+def quantize_conv_stack(model, calibration_segments, engine='fbgemm', channels_last=True,
+                        batch_size=64):
+    '''
+    Int8 ConvStack of model calibrated on calibration_segments
+    (n x 1 x n_mels x segment_size).
+    '''
+    t.backends.quantized.engine = engine
+    stack = ConvStack(model.cpu().eval(), channels_last)
+    stack.qconfig = t.quantization.get_default_qconfig(engine)
+    t.quantization.prepare(stack, inplace=True)
+    with t.no_grad():
+        for i in range(0, calibration_segments.size(0), batch_size):
+            stack(calibration_segments[i:i + batch_size])
+    return t.quantization.convert(stack, inplace=True)
+
+
+def save_conv_stack(stack, path, n_mels, segment_size, engine):
+    '''
+    Load with load_conv_stack from src/models/simple_cnn/inference.py.
+    engine: quantized engine the stack was quantized for, saved in the file.
+    '''
+    with t.no_grad():
+        traced = t.jit.trace(stack, t.randn(2, 1, n_mels, segment_size))
+    t.jit.save(traced, path, _extra_files={ENGINE_FILENAME: engine})
+
+
+def model_collate(model, mel_stats, normalization):
+    '''Collate that normalizes mel spectrograms the way model was trained.'''
+    if model.front_end is not None:
+        front_end = model.front_end
+        return Collate(
+            model.segment_size, front_end.min_log, front_end.max_log,
+            front_end.mel_mean, front_end.mel_std
+        )
+    return Collate.from_stats(model.segment_size, mel_stats, normalization)
+
+
+def iter_batches(dataset, collate, batch_size):
+    for start in range(0, len(dataset), batch_size):
+        yield collate([dataset[i] for i in range(start, min(start + batch_size, len(dataset)))])
+
+
+def real_segments(batch, n_mels, segment_size):
+    '''Segments (n x 1 x n_mels x segment_size) of a collated batch without padding segments.'''
+    mel_specs = batch['mel_specs']
+    n_segments = mel_specs.size(2) // segment_size
+    segments = (
+        mel_specs
+        .reshape(mel_specs.size(0), n_mels, n_segments, segment_size)
+        .permute(0, 2, 1, 3)
+    )
+    mask = t.arange(n_segments).unsqueeze(0) < batch['segment_lengths'].view(-1, 1)
+    return segments[mask].unsqueeze(1)
+
+
+def per_class_roc_auc(expectations, predictions):
+    '''ROC AUC of every class with positive and negative samples, NaN for other classes.'''
+    scores = np.full(expectations.shape[1], np.nan)
+    for i in range(expectations.shape[1]):
+        if 0 < expectations[:, i].sum() < len(expectations):
+            scores[i] = roc_auc_score(expectations[:, i], predictions[:, i])
+    return scores
+
+
+def benchmark(segment_features, segments, n_runs):
+    '''Mean seconds per call after one warm-up call.'''
+    with t.no_grad():
+        segment_features(segments)
+        start_time = time.perf_counter()
+        for _ in range(n_runs):
+            segment_features(segments)
+    return (time.perf_counter() - start_time) / n_runs
+
+
+@click.command()
+@click.argument('checkpoint_path', type=click.Path(exists=True))
+@click.argument('output_dir', type=click.Path())
+@click.option('--meta_path', default='./data/processed/prepared_data/train.csv')
+@click.option('--mels_dir', default='./data/processed/prepared_data')
+@click.option('--storage', type=click.Choice(['pt', 'shards']), default='pt')
+@click.option('--stats_path', default=None,
+              help='Statistics the checkpoint was trained with, those of --fold by default, '
+                   'only used for checkpoints that do not record them')
+@click.option('--normalization', type=click.Choice(['minmax', 'standard']), default='minmax',
+              help='Used with --stats_path')
+@click.option('--n_folds', default=5)
+@click.option('--fold', default=0, help='Validation fold of the checkpoint, used for evaluation')
+@click.option('--folds_seed', default=123, help='Seed the folds were built with in train_model.py')
+@click.option('--n_calibration', default=256, help='Train recordings used for calibration')
+@click.option('--n_eval', default=1024, help='Validation recordings used for evaluation')
+@click.option('--max_segments', default=8, help='Segments read from every recording')
+@click.option('--engine', type=click.Choice(['fbgemm', 'qnnpack']), default='fbgemm')
+@click.option('--batch_size', default=64, help='Segments per call of the conv stack')
+@click.option('--n_runs', default=10)
+@click.option('--n_threads', default=1)
+@click.option('--seed', default=123, help='Seed of calibration and evaluation sampling')
+def main(checkpoint_path, output_dir, meta_path, mels_dir, storage, stats_path, normalization,
+         n_folds, fold, folds_seed, n_calibration, n_eval, max_segments, engine, batch_size,
+         n_runs, n_threads, seed):
+    t.set_num_threads(n_threads)
+    np.random.seed(seed)
+    t.manual_seed(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = SimpleCNN.load_from_checkpoint(checkpoint_path, map_location='cpu').eval()
+    mel_stats = None
+    if model.normalization is not None:
+        mel_stats = model.normalization
+        normalization = model.normalization['mode']
+    elif model.front_end is None:
+        if stats_path is None:
+            stats_path = os.path.join(mels_dir, fold_stats_filename(fold, n_folds))
+        mel_stats = read_mel_stats(stats_path)
+    collate = model_collate(model, mel_stats, normalization)
+    crop_frames = max_segments * model.segment_size
+
+    df = pd.read_csv(meta_path)
+    folds = load_folds(meta_path, df, n_folds, folds_seed)
+    train_df = df[folds != fold]
+    test_df = df[folds == fold]
+    calibration_df = train_df.sample(min(n_calibration, len(train_df)), random_state=seed)
+    eval_df = test_df.sample(min(n_eval, len(test_df)), random_state=seed)
+
+    calibration_dataset = BirdMelTrainDataset(
+        calibration_df, mels_dir, True, storage=storage, crop_frames=crop_frames
+    )
+    calibration_segments = t.cat([
+        real_segments(batch, model.n_mels, model.segment_size)
+        for batch in iter_batches(calibration_dataset, collate, 16)
+    ])
+    print(f'Calibrating on {calibration_segments.size(0)} segments')
+
+    stack = quantize_conv_stack(model, calibration_segments, engine, True, batch_size)
+    path = os.path.join(output_dir, QUANTIZED_FILENAME)
+    save_conv_stack(stack, path, model.n_mels, model.segment_size, engine)
+    print(f'Saved {path}')
+
+    # Per class ROC AUC of the float and int8 models on the validation fold
+    float_graph = SimpleCNNGraph(model)
+    int8_graph = SimpleCNNGraph(model, stack)
+    eval_dataset = BirdMelTrainDataset(
+        eval_df, mels_dir, True, storage=storage, crop_frames=crop_frames
+    )
+    expectations = []
+    float_predictions = []
+    int8_predictions = []
+    with t.no_grad():
+        for batch in iter_batches(eval_dataset, collate, 16):
+            inputs = (batch['mel_specs'], batch['segment_lengths'])
+            expectations.append(batch['encoded_ebird_codes'].numpy())
+            float_predictions.append(t.sigmoid(float_graph(*inputs)).numpy())
+            int8_predictions.append(t.sigmoid(int8_graph(*inputs)).numpy())
+    expectations = np.concatenate(expectations)
+    float_auc = per_class_roc_auc(expectations, np.concatenate(float_predictions))
+    int8_auc = per_class_roc_auc(expectations, np.concatenate(int8_predictions))
+
+    auc_df = pd.DataFrame({
+        'ebird_code': INDEX_TO_EBIRD_CODE,
+        'float_auc': float_auc,
+        'int8_auc': int8_auc,
+        'delta': int8_auc - float_auc,
+    }).dropna()
+    auc_df.to_csv(os.path.join(output_dir, 'int8_auc_delta.csv'), index=False)
+    print(f'ROC AUC over {len(auc_df)} classes: float {auc_df["float_auc"].mean():.4f}, '
+          f'int8 {auc_df["int8_auc"].mean():.4f}, delta mean {auc_df["delta"].mean():+.4f}, '
+          f'min {auc_df["delta"].min():+.4f}, max {auc_df["delta"].max():+.4f}')
+    print('Largest drops:')
+    print(auc_df.nsmallest(10, 'delta').to_string(index=False))
+
+    # Conv stack speedup on one batch of calibration segments
+    segments = calibration_segments[:batch_size]
+    float_time = benchmark(model.segment_features, segments, n_runs)
+    variants = [
+        ('float', model.segment_features),
+        ('float fused', ConvStack(model)),
+        ('float fused channels-last', ConvStack(model, channels_last=True)),
+        ('int8 channels-last', stack),
+    ]
+    print(f'Conv stack, {segments.size(0)} segments, {n_threads} threads:')
+    for name, segment_features in variants:
+        seconds = benchmark(segment_features, segments, n_runs)
+        print(f'{name:<26} {seconds * 1000:>8.2f} ms  {float_time / seconds:>5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import os
 import click
 import random
 import numpy as np
@@ -6,65 +7,198 @@ import torch as t
 import pytorch_lightning as pl
 import warnings
 
-from src.models.simple_cnn.model import SimpleCNN, Collate
-from src.data.dataset import BirdMelTrainDataset
-from src.data.transforms import RandomTimeShift, RandomTimeResize, SpecMixup, SpecTransform
+from src.models.simple_cnn.model import SimpleCNN, Collate, WaveformCollate
+from src.data.dataset import BirdMelTrainDataset, BirdWaveformTrainDataset
+from src.data.mel_cache import SharedMelCache
+from src.data.mel_store import mel_key, open_mel_store
+from src.data.samplers import SegmentBudgetBatchSampler
+from src.data.folds import load_folds
+from src.data.mel_stats import fold_stats_filename, mismatched_mel_params, read_mel_stats
+from src.data.mixup_sampler import CooccurrencePartnerSampler
+from src.data.transforms import (
+    RandomTimeShift, RandomTimeResize, SpecMixup, BatchSpecMixup, SpecTransform,
+    BatchRandomTimeShift, BatchRandomTimeResize, BatchMasking, BatchCompose,
+    WaveformRandomTimeShift, WaveformRandomTimeResize, WaveformTransform
+)
 from torchaudio.transforms import TimeMasking, FrequencyMasking
 from torchvision.transforms import Compose, RandomApply
 
-from sklearn.model_selection import train_test_split
 
+class MelCacheStatsLogger(pl.Callback):
+    def __init__(self, mel_cache):
+        self.mel_cache = mel_cache
 
-def prepare_datasets(meta_path, mels_dir, random_state=123):
+    def on_epoch_end(self, trainer, pl_module):
+        stats = self.mel_cache.stats()
+        print(f"Mel cache: hit rate {stats['hit_rate']:.3f}, hits {stats['hits']}, "
+              f"misses {stats['misses']}, evictions {stats['evictions']}, "
+              f"cached {stats['n_cached']}/{stats['n_keys']} "
+              f"({stats['cached_bytes'] / 2 ** 30:.2f} GB of {stats['budget'] / 2 ** 30:.2f} GB)")
+
+
+def batch_augmentation():
+    '''Same augmentations as the per-sample train transforms, applied to whole batches.'''
+    return BatchCompose([
+        BatchRandomTimeShift(1.0),
+        BatchRandomTimeResize(p=0.5),
+        BatchMasking(10, 2),
+        BatchMasking(8, 1),
+    ])
+
+
+def prepare_datasets(meta_path, mels_dir, random_state=123, storage='pt', crop_frames=None,
+                     cache_bytes=0, mixup='sample', n_folds=5, fold=0, batch_augment=False,
+                     mixup_partners='uniform'):
+    '''
+    mixup_partners: "uniform" or "cooccurrence" to mix with species that co-occur with
+    the sample's species (see src/data/mixup_sampler.py), used with mixup="sample".
+    batch_augment: leave time shift, resize and masking of train samples to the collate
+    function (see batch_augmentation).
+    Fold number fold of n_folds group-aware folds (see src/data/folds.py) is used for
+    validation.
+    mixup: "sample" to mix samples with samples loaded from a separate mixup dataset,
+    "batch" to leave mixup to the collate function (see BatchSpecMixup).
+    '''
     df = pd.read_csv(meta_path)
 
-    group_ids = df['group_id'].unique()
-    group_ebird_codes = [df[df['group_id'] == x].iloc[0]['ebird_code'] for x in group_ids]
-    train_group_ids, test_group_ids = train_test_split(
-        group_ids,
-        test_size=0.2,
-        stratify=group_ebird_codes,
-        random_state=random_state
-    )
-    train_group_ids = set(train_group_ids)
-    test_group_ids = set(test_group_ids)
+    folds = load_folds(meta_path, df, n_folds, random_state)
+    train_df = df[folds != fold]
+    test_df = df[folds == fold]
 
-    train_df = df[df['group_id'].isin(train_group_ids)]
-    test_df = df[df['group_id'].isin(test_group_ids)]
+    # Mixup partners are read from the same files, so both train datasets share the cache
+    mel_cache = None
+    if cache_bytes > 0:
+        mel_cache = SharedMelCache(
+            open_mel_store(mels_dir, storage),
+            [mel_key(x, y) for x, y in zip(train_df['ebird_code'], train_df['filename'])],
+            cache_bytes
+        )
 
-    train_mixup_dataset = BirdMelTrainDataset(
-        train_df,
-        mels_dir,
-        True,
-        Compose([
+    if batch_augment:
+        train_transforms = []
+    else:
+        train_transforms = [
             SpecTransform(RandomTimeShift(1.0)),
             RandomApply([SpecTransform(RandomTimeResize(resize_mode='bilinear'))], 0.5),
-        ])
-    )
+            SpecTransform(TimeMasking(10)),
+            SpecTransform(FrequencyMasking(8)),
+        ]
+    if mixup == 'sample':
+        train_mixup_dataset = BirdMelTrainDataset(
+            train_df,
+            mels_dir,
+            True,
+            Compose([
+                SpecTransform(RandomTimeShift(1.0)),
+                RandomApply([SpecTransform(RandomTimeResize(resize_mode='bilinear'))], 0.5),
+            ]),
+            storage,
+            crop_frames,
+            mel_cache
+        )
+        partner_sampler = None
+        if mixup_partners == 'cooccurrence':
+            partner_sampler = CooccurrencePartnerSampler(
+                train_mixup_dataset.labels, train_df['location'].values
+            )
+        train_transforms.insert(0, RandomApply(
+            [SpecMixup(train_mixup_dataset, 0.5, True, partner_sampler)], 0.5
+        ))
+
     train_dataset = BirdMelTrainDataset(
         train_df,
         mels_dir,
         True,
-        Compose([
-            RandomApply([SpecMixup(train_mixup_dataset, 0.5, True)], 0.5),
-            SpecTransform(RandomTimeShift(1.0)),
-            RandomApply([SpecTransform(RandomTimeResize(resize_mode='bilinear'))], 0.5),
-            SpecTransform(TimeMasking(10)),
-            SpecTransform(FrequencyMasking(8)),
-        ])
+        Compose(train_transforms),
+        storage,
+        crop_frames,
+        mel_cache
     )
 
     test_dataset = BirdMelTrainDataset(
         test_df,
         mels_dir,
-        True
+        True,
+        storage=storage
     )
 
     return train_dataset, test_dataset
 
 
+def prepare_waveform_datasets(meta_path, data_dir, random_state=123, crop_samples=None,
+                              n_folds=5, fold=0):
+    '''
+    Datasets of waveforms saved by prepare_data.py --save_waveforms. Mel spectrograms and
+    masking are computed by the model (see MelFrontEnd), mixup is done by WaveformCollate.
+    '''
+    df = pd.read_csv(meta_path)
+
+    folds = load_folds(meta_path, df, n_folds, random_state)
+    train_df = df[folds != fold]
+    test_df = df[folds == fold]
+
+    train_dataset = BirdWaveformTrainDataset(
+        train_df,
+        data_dir,
+        True,
+        Compose([
+            WaveformTransform(WaveformRandomTimeShift(1.0)),
+            RandomApply([WaveformTransform(WaveformRandomTimeResize())], 0.5),
+        ]),
+        crop_samples
+    )
+    test_dataset = BirdWaveformTrainDataset(test_df, data_dir, True)
+
+    return train_dataset, test_dataset
+
+
 @click.command()
-def main():
+@click.option('--storage', type=click.Choice(['pt', 'shards']), default='pt')
+@click.option('--stats_path', default=None,
+              help='Normalization statistics saved by prepare_data.py, statistics of the '
+                   'training folds of --fold by default')
+@click.option('--normalization', type=click.Choice(['minmax', 'standard']), default='minmax')
+@click.option('--crop_frames', default=None, type=int,
+              help='Train on random crops of this many frames instead of whole spectrograms')
+@click.option('--cache_gb', default=0.,
+              help='Size of the mel spectrogram cache shared by DataLoader workers, 0 to disable')
+@click.option('--mixup', type=click.Choice(['sample', 'batch']), default='sample',
+              help='Mix with samples loaded from a mixup dataset or with samples of the same batch')
+@click.option('--segment_budget', default=None, type=int,
+              help='Batch items of similar length up to this many padded 256 frame segments '
+                   'per batch instead of 4 items per batch')
+@click.option('--mixup_partners', type=click.Choice(['uniform', 'cooccurrence']),
+              default='uniform', help='How mixup partners are chosen with --mixup sample')
+@click.option('--n_folds', default=5)
+@click.option('--fold', default=0, help='Fold used for validation')
+@click.option('--batch_augment', is_flag=True,
+              help='Apply time shift, resize and masking to whole batches in the collate function')
+@click.option('--input', 'input_type', type=click.Choice(['mel', 'waveform']), default='mel',
+              help='Train on saved mel spectrograms or on saved waveforms with mel spectrograms '
+                   'computed by the model')
+@click.option('--sampling_rate', default=44100, help='Sampling rate of saved waveforms')
+@click.option('--n_fft', default=2048, help='Used with --input waveform')
+@click.option('--hop_length', default=512, help='Used with --input waveform')
+def main(storage, stats_path, normalization, crop_frames, cache_gb, mixup, segment_budget,
+         mixup_partners, n_folds, fold, batch_augment, input_type, sampling_rate, n_fft,
+         hop_length):
+    if input_type == 'waveform' and (mixup == 'sample' or batch_augment or cache_gb > 0):
+        raise click.UsageError(
+            '--input waveform works only with --mixup batch, without --batch_augment '
+            'and --cache_gb'
+        )
+    if segment_budget is not None and crop_frames is None:
+        # Lengths of whole spectrograms are read from train.csv, not from the saved files
+        if input_type == 'waveform':
+            length_column = BirdWaveformTrainDataset.length_column
+        else:
+            length_column = BirdMelTrainDataset.length_column
+        columns = pd.read_csv('./data/processed/prepared_data/train.csv', nrows=0).columns
+        if length_column not in columns:
+            raise click.UsageError(
+                f'--segment_budget without --crop_frames needs the {length_column} column '
+                f'of train.csv, rerun merge_prepared_data.py to write it'
+            )
 
     warnings.filterwarnings('ignore')  # Remove annoying torch.nn.Upsample warnings
 
@@ -72,33 +206,81 @@ def main():
     t.manual_seed(123)
     random.seed(123)
 
-    train_dataset, test_dataset = prepare_datasets(
-        './data/processed/prepared_data/train.csv',
-        './data/processed/prepared_data',
-        123
-    )
+    if input_type == 'waveform':
+        train_dataset, test_dataset = prepare_waveform_datasets(
+            './data/processed/prepared_data/train.csv',
+            './data/processed/prepared_data',
+            123,
+            None if crop_frames is None else (crop_frames - 1) * hop_length + 1,
+            n_folds,
+            fold
+        )
+    else:
+        train_dataset, test_dataset = prepare_datasets(
+            './data/processed/prepared_data/train.csv',
+            './data/processed/prepared_data',
+            123,
+            storage,
+            crop_frames,
+            int(cache_gb * 2 ** 30),
+            mixup,
+            n_folds,
+            fold,
+            batch_augment,
+            mixup_partners
+        )
 
     print('Created datasets')
 
-    print('Estimating data range')
-    max_log = max([t.log(t.max(x['mel_spec']) + 0.0001) for x in train_dataset])
-    min_log = min([t.log(t.min(x['mel_spec']) + 0.0001) for x in train_dataset])
-
-    # max_log = 13.1293
-    # min_log = -9.2103
+    if stats_path is None:
+        stats_path = os.path.join(
+            './data/processed/prepared_data', fold_stats_filename(fold, n_folds)
+        )
+    mel_stats = read_mel_stats(stats_path)
 
-    print('max_log: ', max_log)
-    print('min_log: ', min_log)
+    print('max_log: ', mel_stats['max_log'])
+    print('min_log: ', mel_stats['min_log'])
 
-    collate = Collate(256, min_log, max_log)
+    batch_mixup = BatchSpecMixup(0.5, 0.5, True) if mixup == 'batch' else None
+    if input_type == 'waveform':
+        collate = WaveformCollate(256, hop_length)
+        train_collate = WaveformCollate(256, hop_length, batch_mixup)
+    else:
+        collate = Collate.from_stats(256, mel_stats, normalization)
+        train_collate = Collate.from_stats(
+            256,
+            mel_stats,
+            normalization,
+            batch_mixup,
+            batch_augmentation() if batch_augment else None
+        )
 
-    train_dataloader = t.utils.data.DataLoader(
-        train_dataset,
-        batch_size=4,
-        shuffle=True,
-        collate_fn=collate,
-        num_workers=12
-    )
+    if segment_budget is None:
+        train_dataloader = t.utils.data.DataLoader(
+            train_dataset,
+            batch_size=4,
+            shuffle=True,
+            collate_fn=train_collate,
+            num_workers=12
+        )
+    else:
+        if crop_frames is not None:
+            n_frames = np.full(len(train_dataset), crop_frames)
+        elif input_type == 'waveform':
+            n_frames = train_dataset.lengths // hop_length + 1
+        else:
+            n_frames = train_dataset.lengths
+        batch_sampler = SegmentBudgetBatchSampler(n_frames, 256, segment_budget)
+        report = batch_sampler.padding_report(4)
+        print(f"Padding: {report['random_padding']:.3f} with 4 random items per batch, "
+              f"{report['bucketed_padding']:.3f} with segment budget {segment_budget} "
+              f"({report['mean_batch_size']:.1f} items per batch)")
+        train_dataloader = t.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=train_collate,
+            num_workers=12
+        )
 
     test_dataloader = t.utils.data.DataLoader(
         test_dataset,
@@ -108,7 +290,47 @@ def main():
         num_workers=8
     )
 
-    model = SimpleCNN(264, 128, 256, 8e-5)
+    front_end = None
+    mel_normalization = None
+    if input_type == 'waveform':
+        # Normalization of the front end is only right for spectrograms like the saved ones
+        mismatched = mismatched_mel_params(
+            mel_stats, target_sampling_rate=sampling_rate, n_fft=n_fft, n_mels=128,
+            hop_length=hop_length
+        )
+        if mismatched:
+            raise click.UsageError(
+                f'{stats_path} was computed with other spectrogram parameters '
+                f'(given, recorded): {mismatched}, rerun merge_prepared_data.py if it '
+                f'does not record them'
+            )
+        front_end = {
+            'sampling_rate': sampling_rate,
+            'n_fft': n_fft,
+            'n_mels': 128,
+            'hop_length': hop_length,
+            'min_log': mel_stats['min_log'],
+            'max_log': mel_stats['max_log'],
+            'mel_mean': mel_stats['mean'] if normalization == 'standard' else None,
+            'mel_std': mel_stats['std'] if normalization == 'standard' else None,
+            'time_mask': 10,
+            'freq_mask': 8,
+        }
+    else:
+        # Recorded in the checkpoint, so inference normalizes like training
+        mel_normalization = {
+            'mode': normalization,
+            'stats_path': stats_path,
+            'min_log': mel_stats['min_log'],
+            'max_log': mel_stats['max_log'],
+            'mean': mel_stats['mean'],
+            'std': mel_stats['std'],
+        }
+    model = SimpleCNN(264, 128, 256, 8e-5, front_end, mel_normalization)
+
+    callbacks = [pl.callbacks.LearningRateLogger()]
+    if cache_gb > 0:
+        callbacks.append(MelCacheStatsLogger(train_dataset.mel_store))
 
     trainer = pl.Trainer(
         # fast_dev_run=True,
@@ -117,7 +339,7 @@ def main():
         accumulate_grad_batches=4,
         row_log_interval=64,
         auto_lr_find=False,
-        callbacks=[pl.callbacks.LearningRateLogger()],
+        callbacks=callbacks,
         early_stop_callback=pl.callbacks.EarlyStopping(
             monitor='val_loss',
             min_delta=0.0001,